@@ -1 +1,6 @@
-__version__ = __import__('pkg_resources').require(__name__)
+def __getattr__(name):
+    # Looked up on first use, since importing pkg_resources takes a large fraction of a
+    # second, which worker processes would otherwise pay on every start
+    if name == '__version__':
+        return __import__('pkg_resources').require(__name__)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
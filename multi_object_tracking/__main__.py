@@ -1,15 +1,21 @@
 import argparse
 import glob
-import json
 import os
-
-import tqdm
+import sys
 
 from . import params
 
 EXTS = ('mp4', 'avi', 'mov', 'mpeg', 'flv', 'wmv')
 
 
+def tile_layout(value):
+    try:
+        rows, cols = map(int, value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Expected a layout like 2x2, got {value}')
+    return rows, cols
+
+
 parser = argparse.ArgumentParser()
 parser.add_argument(
     '-p', '--path', default='videos',
@@ -26,34 +32,104 @@ parser.add_argument(
 parser.add_argument(
     '-e', '--end', default=None, type=int,
     help='The frame number at which to stop. (Stop at the end by default.)')
+parser.add_argument(
+    '-w', '--workers', default=1, type=int,
+    help='Number of videos to process in parallel, each in its own process. (Default 1.)')
+parser.add_argument(
+    '--pipeline', action='store_true',
+    help='Run decoding, background subtraction and detection on separate threads.')
+split = parser.add_mutually_exclusive_group()
+split.add_argument(
+    '--tiles', type=tile_layout,
+    help='Track each tile of a ROWSxCOLUMNS grid independently, e.g. 2x2 for videos which '
+         'are mosaics of four cameras. Also writes per-tile counts.')
+split.add_argument(
+    '--segments', type=int,
+    help='Split each video into this many time segments and track them in parallel.')
+parser.add_argument(
+    '--checkpoint-dir',
+    help='If present, periodically save the state of each run to this directory. Not with '
+         '--tiles or --segments.')
+parser.add_argument(
+    '--checkpoint-every', default=1000, type=int,
+    help='Number of frames between checkpoints. (Default 1000.)')
+parser.add_argument(
+    '--resume', action='store_true',
+    help='Carry on from the checkpoints in --checkpoint-dir, e.g. after being killed.')
+parser.add_argument(
+    '--detection-cache',
+    help='If present, cache the observations in each video in this directory, so that '
+         'runs which only change the ASSOC_*, UPD_* or TRACK_* parameters skip detection. '
+         'Not with --segments.')
+parser.add_argument(
+    '--detection-cache-size', default=10., type=float,
+    help='Size in GB beyond which the least recently used cache entries are evicted. '
+         '(Default 10.)')
+parser.add_argument(
+    '--decoder', default='opencv', choices=['opencv', 'ffmpeg'],
+    help='Decode with OpenCV, or pipe greyscale frames from ffmpeg, which must be on the '
+         'PATH. (Default opencv.)')
+parser.add_argument(
+    '--stride', default=1, type=int,
+    help='Track only every STRIDE-th frame, skipping the others without decoding them, '
+         'e.g. for high frame rate videos in which objects move less than a pixel per '
+         'frame. Counts are still one per frame. Not with --tiles, --segments or '
+         '--checkpoint-dir. (Default 1.)')
+parser.add_argument(
+    '--metrics-out',
+    help='If present, write the time spent in each stage and the numbers of observations '
+         'and filters, per frame, to this directory. Not with --pipeline, --tiles or '
+         '--segments.')
+parser.add_argument(
+    '--metrics-format', default='csv', choices=['csv', 'jsonl'],
+    help='File format of --metrics-out. (Default csv.)')
 parser.add_argument(
     '--params', help='Override the default model parameters by passing a file.')
-args, _ = parser.parse_known_args()
-debug = args.debug_out is not None
-params.init(args.params)
-
-
-# Move expensive imports below argument parsing so that `--help` still runs quickly
-import numpy as np  # noqa: E402
-import scipy.stats  # noqa: E402
-from .track import track  # noqa: E402
-
-
-videos = []
-for ext in EXTS:
-    videos.extend(glob.glob(os.path.join(args.path, f'*.{ext}')))
-
-with open(args.out, 'w') as f:
-    for video in tqdm.tqdm(videos):
-        print(f'Processing {video}')
-        filter_counts, debug_data = track(video, debug, args.start, args.end)
-        filter_counts_array = np.array(filter_counts)
-        mean, std = filter_counts_array.mean(), filter_counts_array.std()
-        lower, upper = scipy.stats.norm.interval(0.95, loc=mean, scale=std)
-        f.write(f'{video}: {np.round(mean):.0f}, [{max(lower, 0):.1f}, {upper:.1f}]\n')
-
-        if debug:
-            debug_path = os.path.join(args.debug_out, f'{os.path.basename(video)}.json')
-            print(f'Writing debug output to {debug_path}')
-            with open(debug_path, 'w') as dp:
-                json.dump(debug_data, dp)
+
+
+# Worker processes may import this module, so only run when executed as a script.
+if __name__ == '__main__':
+    args, _ = parser.parse_known_args()
+    if args.resume and args.checkpoint_dir is None:
+        parser.error('--resume needs --checkpoint-dir')
+    if args.checkpoint_dir is not None and (args.tiles or args.segments):
+        parser.error('--checkpoint-dir can only be used without --tiles or --segments')
+    if args.detection_cache is not None and args.segments:
+        parser.error('--detection-cache can only be used without --segments')
+    if args.metrics_out is not None and (args.pipeline or args.tiles or args.segments):
+        parser.error('--metrics-out can only be used without --pipeline, --tiles or --segments')
+    if args.stride < 1:
+        parser.error('--stride must be at least 1')
+    if args.stride > 1 and (args.tiles or args.segments or args.checkpoint_dir):
+        parser.error('--stride can only be used without --tiles, --segments or --checkpoint-dir')
+    params.init(args.params)
+
+    # Move expensive imports below argument parsing so that `--help` still runs quickly
+    from .batch import count_videos
+
+    videos = []
+    for ext in EXTS:
+        videos.extend(glob.glob(os.path.join(args.path, f'*.{ext}')))
+
+    failed = []
+    with open(args.out, 'w') as f:
+        for video, line, error in count_videos(
+                videos, args.workers, args.params,
+                debug_out=args.debug_out, start=args.start, end=args.end,
+                pipelined=args.pipeline, tiles=args.tiles, segments=args.segments,
+                checkpoint_dir=args.checkpoint_dir, checkpoint_every=args.checkpoint_every,
+                resume=args.resume, detection_cache_dir=args.detection_cache,
+                detection_cache_max_bytes=int(args.detection_cache_size * 2**30),
+                metrics_out=args.metrics_out, metrics_format=args.metrics_format,
+                decoder=args.decoder, stride=args.stride):
+            if error is not None:
+                print(f'Failed to process {video}:\n{error}', file=sys.stderr)
+                failed.append(video)
+                continue
+            f.write(line)
+            f.flush()
+
+    if failed:
+        print(f'{len(failed)} of {len(videos)} videos failed: {", ".join(failed)}',
+              file=sys.stderr)
+        sys.exit(1)
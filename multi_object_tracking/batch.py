@@ -0,0 +1,190 @@
+"""
+Counting objects in a batch of videos, optionally fanned out to a pool of worker processes.
+"""
+import concurrent.futures
+import contextlib
+import os
+import traceback
+
+import numpy as np
+
+from . import params
+from .debug_output import DebugWriter
+from .detection_cache import DEFAULT_MAX_BYTES, DetectionCache
+from .metrics import Metrics
+from .track import track, track_segmented, track_tiled
+
+# scipy.stats.norm.ppf(0.975); scipy.stats itself takes a long time to import
+_Z_95 = 1.959963984540054
+
+
+def summarize(video, filter_counts):
+    filter_counts_array = np.array(filter_counts)
+    mean, std = filter_counts_array.mean(), filter_counts_array.std()
+    lower, upper = mean - _Z_95 * std, mean + _Z_95 * std
+    return f'{video}: {np.round(mean):.0f}, [{max(lower, 0):.1f}, {upper:.1f}]\n'
+
+
+def count_video(video, debug_out=None, start=0, end=None, progress=True, pipelined=False,
+                tiles=None, segments=None, checkpoint_dir=None, checkpoint_every=1000,
+                resume=False, detection_cache_dir=None,
+                detection_cache_max_bytes=DEFAULT_MAX_BYTES, metrics_out=None,
+                metrics_format='csv', decoder='opencv', stride=1):
+    """
+    Tracks objects in one video and returns its line of the output file. If `debug_out`
+    is given, the debug data is written there as `<video basename>.debug` (see
+    `debug_output`).
+
+    If `tiles` is given as (rows, columns), each tile is tracked separately (see
+    `track_tiled`), and the total line is followed by one line per tile. If `segments` is
+    given, the video is split into that many time segments which are tracked in parallel
+    (see `track_segmented`).
+
+    If `checkpoint_dir` is given, the run is checkpointed there every `checkpoint_every`
+    frames, as `<video basename>.checkpoint.npz`, and with `resume` it carries on from
+    an existing checkpoint (see `track`).
+
+    If `detection_cache_dir` is given, observations are cached there (see
+    `detection_cache`), and the least recently used ones are evicted once the cache
+    grows beyond `detection_cache_max_bytes`.
+
+    If `metrics_out` is given, per-frame stage times and counts (see `metrics`) are
+    written there as `<video basename>.metrics.csv`, or `.metrics.jsonl` if
+    `metrics_format` is 'jsonl'.
+
+    Frames are decoded by `decoder` (see `preprocess.stream_video`). With `stride`, only
+    every `stride`-th frame is tracked (see `track`).
+    """
+    if checkpoint_dir is not None and (tiles is not None or segments is not None):
+        raise ValueError('Checkpoints can only be used without tiles or segments')
+    if detection_cache_dir is not None and segments is not None:
+        raise ValueError('The detection cache can only be used without segments')
+    if metrics_out is not None and (tiles is not None or segments is not None or pipelined):
+        raise ValueError('Metrics can only be recorded without tiles, segments or pipeline')
+    if stride > 1 and (tiles is not None or segments is not None or checkpoint_dir is not None):
+        raise ValueError('A stride can only be used without tiles, segments or checkpoints')
+
+    cache = None
+    if detection_cache_dir is not None:
+        cache = DetectionCache(detection_cache_dir, detection_cache_max_bytes)
+
+    with contextlib.ExitStack() as stack:
+        writer = None
+        if debug_out is not None:
+            debug_path = os.path.join(debug_out, f'{os.path.basename(video)}.debug')
+            print(f'Writing debug output to {debug_path}')
+            writer = stack.enter_context(
+                DebugWriter(debug_path, resume=resume, frame_step=stride))
+
+        checkpoint_path = None
+        if checkpoint_dir is not None:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            checkpoint_path = os.path.join(
+                checkpoint_dir, f'{os.path.basename(video)}.checkpoint.npz')
+
+        if segments is not None:
+            filter_counts, _ = track_segmented(
+                video, segments, start=start, end=end, pipelined=pipelined,
+                decoder=decoder, debug_writer=writer)
+            return summarize(video, filter_counts)
+
+        if tiles is None:
+            metrics = None
+            if metrics_out is not None:
+                metrics_path = os.path.join(
+                    metrics_out, f'{os.path.basename(video)}.metrics.{metrics_format}')
+                print(f'Writing metrics to {metrics_path}')
+                metrics = stack.enter_context(Metrics(metrics_path))
+            filter_counts, _ = track(
+                video, False, start, end, progress=progress, pipelined=pipelined,
+                debug_writer=writer, checkpoint_path=checkpoint_path,
+                checkpoint_every=checkpoint_every, resume=resume, detection_cache=cache,
+                metrics=metrics, decoder=decoder, stride=stride)
+            return summarize(video, filter_counts)
+
+        filter_counts, tile_counts, _ = track_tiled(
+            video, tiles, start=start, end=end, pipelined=pipelined,
+            detection_cache=cache, decoder=decoder, debug_writer=writer)
+        return summarize(video, filter_counts) + ''.join(
+            summarize(f'{video} (tile {i})', counts)
+            for i, counts in enumerate(tile_counts, 1)
+        )
+
+
+def _count_video_or_error(video, **kwargs):
+    try:
+        return count_video(video, **kwargs), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def count_videos(videos, workers=1, params_filename=None, **kwargs):
+    """
+    Runs `count_video` on each video and yields tuples (video, output line, error), in the
+    same order as `videos`. Exactly one of the output line and the error is None, so a
+    video that fails, even by crashing its worker process, doesn't stop the others.
+
+    With more than one worker, videos are processed in a process pool. Each worker loads
+    the parameters from `params_filename` (or the defaults), and reports no per-frame
+    progress; instead there's one progress bar counting finished videos.
+    """
+    # Imported here, so that worker processes, which import this module, start faster
+    import tqdm
+
+    if workers <= 1:
+        for video in tqdm.tqdm(videos):
+            print(f'Processing {video}')
+            yield (video, *_count_video_or_error(video, **kwargs))
+        return
+
+    # Results arrive in any order; hold them back until all earlier videos are done.
+    results = {}
+    next_index = 0
+    for index, result in tqdm.tqdm(
+            _count_videos_unordered(videos, workers, params_filename, kwargs),
+            total=len(videos)):
+        results[index] = result
+        while next_index in results:
+            yield (videos[next_index], *results.pop(next_index))
+            next_index += 1
+
+
+def _count_videos_unordered(videos, workers, params_filename, kwargs):
+    """
+    Counts `videos` in a pool of `workers` processes, and yields (index, (output line,
+    error)) for each one as it finishes.
+
+    If a worker dies outright (e.g. a crash inside the decoder), the whole pool breaks,
+    and every video which hadn't finished fails along with it. Those are counted again
+    afterwards, each in a process of its own, so that only the video which crashed fails.
+    """
+    crashed = []
+    with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=params.init, initargs=(params_filename,)) as executor:
+        futures = {
+            executor.submit(_count_video_or_error, video, progress=False, **kwargs): i
+            for i, video in enumerate(videos)
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except concurrent.futures.process.BrokenProcessPool:
+                crashed.append(futures[future])
+                continue
+            yield futures[future], result
+
+    crashed.sort()
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        yield from zip(crashed, executor.map(
+            lambda i: _count_video_alone(videos[i], params_filename, kwargs), crashed))
+
+
+def _count_video_alone(video, params_filename, kwargs):
+    with concurrent.futures.ProcessPoolExecutor(
+            1, initializer=params.init, initargs=(params_filename,)) as executor:
+        try:
+            return executor.submit(
+                _count_video_or_error, video, progress=False, **kwargs).result()
+        except concurrent.futures.process.BrokenProcessPool:
+            # The worker died outright
+            return None, traceback.format_exc()
@@ -0,0 +1,5 @@
+"""
+Benchmarks on synthetic videos with known ground truth, so that performance work can be
+measured without access to the labelled videos. Run with
+`python -m multi_object_tracking.benchmark --help`.
+"""
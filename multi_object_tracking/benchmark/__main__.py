@@ -0,0 +1,85 @@
+import argparse
+import json
+import sys
+
+from .. import params
+
+parser = argparse.ArgumentParser('Benchmark each stage of tracking on synthetic videos.')
+parser.add_argument(
+    '--scenario', action='append', choices=['sparse', 'dense', 'custom'],
+    help='Scenario to run; may be repeated. (Default all but custom.) The custom scenario '
+         'is described by the options below.')
+parser.add_argument('--width', default=640, type=int, help='Custom scenario frame width.')
+parser.add_argument('--height', default=512, type=int, help='Custom scenario frame height.')
+parser.add_argument(
+    '--frames', default=300, type=int, help='Custom scenario number of frames.')
+parser.add_argument(
+    '--objects', default=30, type=int, help='Custom scenario number of objects.')
+parser.add_argument(
+    '--blob-size', default=4., type=float, help='Custom scenario blob length in pixels.')
+parser.add_argument(
+    '--drift', default=20., type=float,
+    help='Custom scenario change in background brightness over the video, in grey levels.')
+parser.add_argument(
+    '--videos', default='benchmark_videos',
+    help='Directory in which to keep the generated videos, which are reused between runs.')
+parser.add_argument(
+    '--repeat', default=3, type=int,
+    help='Number of runs per scenario; stage times are the best of these. (Default 3.)')
+parser.add_argument('-o', '--out', help='Path to save the results to, as JSON.')
+parser.add_argument(
+    '--baseline', help='Path to results saved earlier; exit with status 1 if any stage is '
+                       'slower, or memory use higher, by more than --tolerance.')
+parser.add_argument(
+    '--tolerance', default=0.2, type=float,
+    help='Allowed fractional regression against the baseline. (Default 0.2.)')
+parser.add_argument(
+    '--no-startup', action='store_true',
+    help="Don't measure how long a fresh process takes to import the tracker.")
+parser.add_argument(
+    '--params', help='Override the default model parameters by passing a file.')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    params.init(args.params)
+
+    from . import startup
+    from .run import SCENARIOS, STAGES, compare, run
+
+    names = args.scenario or list(SCENARIOS)
+    scenarios = {
+        name: SCENARIOS[name] if name != 'custom' else dict(
+            width=args.width, height=args.height, num_frames=args.frames,
+            num_objects=args.objects, blob_size=args.blob_size, drift=args.drift)
+        for name in names
+    }
+    results = run(scenarios, args.videos, args.repeat)
+    if not args.no_startup:
+        results['startup'] = startup.run(repeat=max(args.repeat, 5))
+
+    for name, result in results['scenarios'].items():
+        peak = result['peak_rss_mb']
+        print(f'{name}: {result["frames"]} frames, {result["fps"]:.1f} frames/s overall'
+              + ('' if peak is None else f', peak memory {peak:.0f} MB'))
+        for stage in STAGES:
+            print(f'  {stage:>12}: {result["stages"][stage]["fps"]:10.1f} frames/s')
+    for module, result in results.get('startup', {}).items():
+        heavy = ', '.join(result['heavy']) or 'nothing heavy'
+        print(f'import {module}: {result["seconds"] * 1e3:.0f} ms ({heavy})')
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if 'startup' in results and 'startup' in baseline:
+            regressions += startup.compare(
+                results['startup'], baseline['startup'], args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,131 @@
+"""
+Runs the tracker over synthetic videos, timing each stage separately (see `metrics`),
+and compares the results with a stored baseline. Each run happens in a fresh process,
+so that its peak resident memory is its own.
+"""
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+
+import numpy as np
+
+from .. import params
+from .. import track
+from ..metrics import STAGES, Metrics
+from . import synthetic
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+SCENARIOS = {
+    'sparse': dict(width=640, height=512, num_frames=300, num_objects=20),
+    'dense': dict(width=1280, height=1024, num_frames=200, num_objects=300),
+}
+
+
+def time_stages(video, config=None):
+    """
+    Tracks `video` and returns the seconds spent in each stage, and the number of live
+    filters in each frame.
+    """
+    metrics = Metrics()
+    counts, _ = track.track(video, progress=False, config=config, metrics=metrics)
+    return metrics.totals(), counts
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if platform.system() == 'Darwin' else peak / 2**10
+
+
+def _run_in_process(video, values):
+    seconds, counts = time_stages(video, params.Params(values))
+    return seconds, counts, _peak_rss_mb()
+
+
+def scenario_video(directory, scenario):
+    """
+    Returns the path of the video for a scenario (a dict of arguments to
+    `synthetic.make_video`) in `directory`, and its true positions, making them if
+    they don't exist yet.
+    """
+    name = hashlib.sha256(json.dumps(scenario, sort_keys=True).encode()).hexdigest()[:16]
+    video = os.path.join(directory, f'synthetic-{name}.avi')
+    truth = os.path.join(directory, f'synthetic-{name}.npy')
+    if not (os.path.isfile(video) and os.path.isfile(truth)):
+        os.makedirs(directory, exist_ok=True)
+        np.save(truth, synthetic.make_video(video, **scenario))
+    return video, np.load(truth)
+
+
+def run(scenarios, directory, repeat=3, config=None):
+    """
+    Benchmarks each of `scenarios`, a dict from name to arguments of
+    `synthetic.make_video`, `repeat` times, and returns the results as a dict which can
+    be saved as JSON. Stage times are the best of the repeats; peak memory is the worst.
+    """
+    config = params.resolve(config)
+    results = dict(
+        python=platform.python_version(),
+        numpy=np.__version__,
+        machine=platform.machine(),
+        scenarios={},
+    )
+    context = multiprocessing.get_context('spawn')
+    for name, scenario in scenarios.items():
+        video, truth = scenario_video(directory, scenario)
+        runs = []
+        for _ in range(repeat):
+            with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+                runs.append(executor.submit(_run_in_process, video, config.values()).result())
+
+        num_frames = len(runs[0][1])
+        seconds = {stage: min(s[stage] for s, _, _ in runs) for stage in STAGES}
+        peaks = [peak for _, _, peak in runs if peak is not None]
+        results['scenarios'][name] = dict(
+            scenario=scenario,
+            frames=num_frames,
+            stages={
+                stage: dict(seconds=seconds[stage], fps=num_frames / max(seconds[stage], 1e-9))
+                for stage in STAGES
+            },
+            fps=num_frames / sum(seconds.values()),
+            peak_rss_mb=max(peaks) if peaks else None,
+            # How far the count is from the truth, on average; for information only
+            mean_count_error=float(np.mean(runs[0][1]) - truth.shape[1]),
+        )
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Returns a list of messages, one for each stage of each scenario in both `results`
+    and `baseline` whose throughput fell by more than `tolerance` (as a fraction), and
+    for each scenario whose peak memory rose by more than that.
+    """
+    regressions = []
+    for name, result in results['scenarios'].items():
+        base = baseline['scenarios'].get(name)
+        if base is None:
+            continue
+        if base['scenario'] != result['scenario']:
+            regressions.append(f'{name}: scenario differs from the baseline, not compared')
+            continue
+        for stage in STAGES:
+            fps, base_fps = result['stages'][stage]['fps'], base['stages'][stage]['fps']
+            if fps < base_fps * (1 - tolerance):
+                regressions.append(
+                    f'{name}/{stage}: {fps:.1f} frames/s, baseline {base_fps:.1f}')
+        peak, base_peak = result['peak_rss_mb'], base['peak_rss_mb']
+        if peak is not None and base_peak is not None and peak > base_peak * (1 + tolerance):
+            regressions.append(f'{name}: peak memory {peak:.0f} MB, baseline {base_peak:.0f} MB')
+    return regressions
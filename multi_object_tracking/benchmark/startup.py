@@ -0,0 +1,78 @@
+"""
+Measures how long a fresh process takes to import the modules a worker needs, and which
+heavy modules come along with them. Each measurement runs in a new interpreter, so that
+nothing is already imported.
+"""
+import json
+import subprocess
+import sys
+
+# What a worker imports: counting a batch of videos, tracking one, or counting live
+MODULES = (
+    'multi_object_tracking.batch',
+    'multi_object_tracking.track',
+    'multi_object_tracking.live',
+)
+
+# Modules which are slow to import and which counting doesn't need
+HEAVY = (
+    'filterpy',
+    'matplotlib',
+    'pkg_resources',
+    'scipy.optimize',
+    'scipy.spatial',
+    'scipy.stats',
+    'tqdm',
+)
+
+_SCRIPT = '''
+import importlib, json, sys, time
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+seconds = time.perf_counter() - start
+heavy = sorted(m for m in json.loads(sys.argv[2]) if m in sys.modules)
+print(json.dumps(dict(seconds=seconds, heavy=heavy)))
+'''
+
+
+def time_import(module, repeat=5):
+    """
+    Imports `module` in `repeat` fresh interpreters, and returns the fastest time in
+    seconds, and which of the HEAVY modules it imported.
+    """
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', _SCRIPT, module, json.dumps(HEAVY)],
+            check=True, stdout=subprocess.PIPE).stdout
+        runs.append(json.loads(output))
+    return min(r['seconds'] for r in runs), runs[0]['heavy']
+
+
+def run(modules=MODULES, repeat=5):
+    """Returns the import time and heavy imports of each of `modules`, as a dict."""
+    results = {}
+    for module in modules:
+        seconds, heavy = time_import(module, repeat)
+        results[module] = dict(seconds=seconds, heavy=heavy)
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Returns a list of messages, one for each module in both `results` and `baseline`
+    which got slower to import by more than `tolerance` (as a fraction), or which imports
+    a heavy module that it didn't before.
+    """
+    regressions = []
+    for module, result in results.items():
+        base = baseline.get(module)
+        if base is None:
+            continue
+        if result['seconds'] > base['seconds'] * (1 + tolerance):
+            regressions.append(
+                f'import {module}: {result["seconds"] * 1e3:.0f} ms, '
+                f'baseline {base["seconds"] * 1e3:.0f} ms')
+        for heavy in sorted(set(result['heavy']) - set(base['heavy'])):
+            regressions.append(f'import {module}: now imports {heavy}')
+    return regressions
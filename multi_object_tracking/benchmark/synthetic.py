@@ -0,0 +1,85 @@
+"""
+Synthetic greyscale videos with known ground truth: dark blobs moving at constant
+velocity (bouncing off the edges, so the number of objects stays fixed) on a light,
+textured background whose brightness drifts slowly over the video.
+"""
+import json
+import os
+
+import cv2 as cv
+import numpy as np
+
+
+def make_video(path, width=640, height=512, num_frames=300, num_objects=30, blob_size=4.,
+               speed=1.5, drift=20., noise=2., seed=0, fps=25):
+    """
+    Writes a synthetic video to `path` (as Motion JPEG, which OpenCV can always write)
+    and returns the true positions of the objects, shape (num_frames, num_objects, 2).
+
+    Each blob is a Gaussian about `blob_size` pixels across along its long axis and half
+    that along the other, `speed` is the typical number of pixels moved per frame, the
+    background brightens by `drift` grey levels from the first frame to the last, and
+    `noise` is the standard deviation of per-pixel noise.
+    """
+    rng = np.random.default_rng(seed)
+    size = np.array([width, height], dtype=float)
+    position = rng.uniform(0, size, (num_objects, 2))
+    velocity = rng.normal(0, speed, (num_objects, 2))
+    sigma = blob_size / 2 * np.stack(
+        [np.ones((num_objects,)), rng.uniform(.4, .6, (num_objects,))], axis=-1)
+    vertical = rng.random(num_objects) < .5
+    sigma[vertical] = sigma[vertical, ::-1]
+
+    texture = 200. + 20. * np.sin(np.arange(width) / 50.)[None, :] \
+        + 10. * np.cos(np.arange(height) / 70.)[:, None]
+    half = int(np.ceil(3 * sigma.max()))
+
+    writer = cv.VideoWriter(path, cv.VideoWriter_fourcc(*'MJPG'), fps, (width, height))
+    if not writer.isOpened():
+        raise ValueError(f"Can't write a video to {path}")
+
+    positions = np.empty((num_frames, num_objects, 2))
+    try:
+        for t in range(num_frames):
+            positions[t] = position
+            frame = texture + drift * t / max(num_frames - 1, 1)
+            for (x, y), (sx, sy) in zip(position, sigma):
+                # Draw each blob into the patch around it only
+                x0, y0 = max(int(x) - half, 0), max(int(y) - half, 0)
+                px = np.arange(x0, min(int(x) + half + 1, width))
+                py = np.arange(y0, min(int(y) + half + 1, height))
+                frame[y0:y0 + len(py), x0:x0 + len(px)] -= 90. * np.exp(
+                    -(px[None, :] - x) ** 2 / (2 * sx * sx)
+                    - (py[:, None] - y) ** 2 / (2 * sy * sy))
+            frame += rng.normal(0, noise, frame.shape)
+            gray = np.clip(frame, 0, 255).astype(np.uint8)
+            writer.write(cv.cvtColor(gray, cv.COLOR_GRAY2BGR))
+
+            position += velocity
+            # Bounce off the edges
+            for axis in (0, 1):
+                low, high = position[:, axis] < 0, position[:, axis] > size[axis] - 1
+                position[low, axis] *= -1
+                position[high, axis] = 2 * (size[axis] - 1) - position[high, axis]
+                velocity[low | high, axis] *= -1
+    finally:
+        writer.release()
+    return positions
+
+
+def write_labels(labels_dir, video, positions, every=10):
+    """
+    Writes the true positions at every `every`th frame as label files for `evaluate`,
+    all in tile 1 of the mosaic (which has no offset).
+    """
+    os.makedirs(labels_dir, exist_ok=True)
+    basename = os.path.splitext(os.path.basename(video))[0]
+    for frame_num in range(0, len(positions), every):
+        shapes = [
+            {'points': [[x - 1., y - 1.], [x + 1., y + 1.]]}
+            for x, y in positions[frame_num].tolist()
+        ]
+        # Label file names are 1-indexed
+        with open(os.path.join(labels_dir, f'{basename}_{frame_num + 1:04d}_1_label.json'),
+                  'w') as f:
+            json.dump({'shapes': shapes}, f)
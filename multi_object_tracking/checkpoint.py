@@ -0,0 +1,87 @@
+"""
+Saving and restoring the state of a `track` run, so that a long run which gets killed
+can carry on from its last checkpoint instead of from the first frame.
+
+A checkpoint is an uncompressed `.npz` file holding the frame range and parameters it
+was made with, the counts so far, the live filters, the position of the filter id
+counter, and the foreground's window buffers. It's written to a temporary file first,
+so a run killed mid-write leaves the previous checkpoint intact.
+"""
+import itertools
+import json
+import os
+
+import numpy as np
+
+from . import params
+from .kalman_filter import KalmanFilterBank
+from .preprocess import Foreground
+
+
+class CheckpointMismatch(ValueError):
+    pass
+
+
+def save(path, start, end, background, filters, rows, filter_counts, done=False, config=None):
+    """
+    Saves the state of a run over frames `start` to `end`, after the frames counted in
+    `filter_counts`. Only the filters at `rows` are kept. With `done`, the run is
+    complete and only the counts are needed. The parameters are taken from `config` (see
+    `params.Params`), or the values currently in effect.
+    """
+    # Read the id counter's position without losing an id
+    next_id = next(KalmanFilterBank.id_iter)
+    KalmanFilterBank.id_iter = itertools.count(next_id)
+
+    arrays = dict(
+        start=start,
+        end=-1 if end is None else end,
+        params=json.dumps(params.resolve(config).values(), sort_keys=True),
+        done=done,
+        next_id=next_id,
+        filter_counts=np.array(filter_counts, dtype=np.int64),
+    )
+    if not done:
+        arrays.update({f'filters_{k}': v for k, v in filters.state(rows).items()})
+        arrays.update({f'background_{k}': v for k, v in background.state().items()})
+
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(temp_path, path)
+
+
+def load(path, start, end, config=None):
+    """
+    Loads a checkpoint saved by `save`, and moves the filter id counter to where it was.
+    Returns a dict with 'filter_counts' and 'done' and, unless done, the restored
+    'background' (a `Foreground`) and 'filters' (a `KalmanFilterBank`).
+
+    Raises CheckpointMismatch if the checkpoint was made for a different range of frames
+    or with different parameters.
+    """
+    config = params.resolve(config)
+    with np.load(path) as data:
+        saved_end = int(data['end'])
+        if (int(data['start']), None if saved_end == -1 else saved_end) != (start, end):
+            raise CheckpointMismatch(
+                f'{path} is for frames {int(data["start"])} to {saved_end}, '
+                f'not {start} to {end}')
+        if str(data['params']) != json.dumps(config.values(), sort_keys=True):
+            raise CheckpointMismatch(f'{path} was made with different parameters')
+
+        KalmanFilterBank.id_iter = itertools.count(int(data['next_id']))
+        checkpoint = dict(
+            filter_counts=data['filter_counts'].tolist(),
+            done=bool(data['done']),
+        )
+        if not checkpoint['done']:
+            checkpoint['filters'] = KalmanFilterBank.from_state({
+                key[len('filters_'):]: data[key]
+                for key in data.files if key.startswith('filters_')
+            }, config)
+            checkpoint['background'] = Foreground.from_state({
+                key[len('background_'):]: data[key]
+                for key in data.files if key.startswith('background_')
+            })
+    return checkpoint
@@ -0,0 +1,276 @@
+"""
+Compact binary debug output, written one frame at a time while tracking and readable one
+frame at a time afterwards.
+
+The file starts with a magic string and the frame step, the number of frames of the
+video from one record to the next (more than 1 when tracking with a stride, see `track`),
+followed by one record per tracked frame. Each record is its
+length in bytes, then the number of observations and filters, then the frame's data as
+flat arrays: observation centroids and covariances, followed by the filters' ids, ages,
+last_observed, last_observation, states x, covariances P and flags (is_duplicate, and
+whether the filter was removed in that frame). When the writer is closed it appends an
+index of record offsets, so that any frame can be read without reading the rest. If the
+index is missing (say the run was killed), the reader rebuilds it by skipping from
+record to record.
+
+`DebugReader(path)[n]` returns the same dict as `track(..., debug=True)` would have for
+frame n, and `DebugReader(path).columns(n)` the arrays it's made from.
+"""
+import os
+
+import numpy as np
+
+MAGIC = b'MOTDBG2\n'
+INDEX_MAGIC = b'MOTDBGIX'
+# Files from before the frame step was recorded, which have one record per frame
+_MAGIC_V1 = b'MOTDBG1\n'
+
+_LENGTH = np.dtype('<u8')
+_COUNTS = np.dtype('<u4')
+
+# (name, dtype, shape of one item); observation columns first, then filter columns
+_OBSERVATION_COLUMNS = (
+    ('centroid', np.dtype('<f8'), (2,)),
+    ('cov', np.dtype('<f8'), (2, 2)),
+)
+_FILTER_COLUMNS = (
+    ('ids', np.dtype('<i8'), ()),
+    ('age', np.dtype('<i8'), ()),
+    ('last_observed', np.dtype('<i8'), ()),
+    ('last_observation', np.dtype('<i8'), ()),
+    ('x', np.dtype('<f8'), (4,)),
+    ('P', np.dtype('<f8'), (4, 4)),
+    ('flags', np.dtype('u1'), ()),
+)
+_DUPLICATE = 1
+_INVALID = 2
+
+
+class DebugWriter:
+    """
+    `frame_step` is the number of frames of the video from one record to the next, which
+    is the stride when tracking with one.
+
+    With `resume`, an existing file is opened without truncating it, and `rewind` must be
+    called to say how many of its frames to keep before any more are added.
+    """
+
+    def __init__(self, path, resume=False, frame_step=1):
+        self.path = path
+        self.frame_step = frame_step
+        if resume and os.path.isfile(path):
+            self._file = open(path, 'r+b')
+            existing_step, self._start = _read_header(self._file, path)
+            if existing_step != frame_step:
+                self._file.close()
+                raise ValueError(
+                    f'{path} has a frame step of {existing_step}, not {frame_step}')
+            self._offsets = None
+        else:
+            self._file = open(path, 'wb')
+            self._file.write(MAGIC + np.array([frame_step], dtype=_LENGTH).tobytes())
+            self._start = self._file.tell()
+            self._offsets = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def rewind(self, num_frames):
+        """Keeps the first `num_frames` frames of the file and drops the rest."""
+        end = self._file.seek(0, os.SEEK_END)
+        offsets = _scan_records(self._file, self._start, end, num_frames)
+        if len(offsets) < num_frames:
+            raise ValueError(
+                f'Debug output has {len(offsets)} complete frames, expected {num_frames}')
+        self._file.seek(self._start)
+        if offsets:
+            self._file.seek(offsets[-1])
+            length = int(np.frombuffer(self._file.read(_LENGTH.itemsize), dtype=_LENGTH)[0])
+            self._file.seek(length, os.SEEK_CUR)
+        self._file.truncate()
+        self._offsets = offsets
+
+    def add_frame(self, observations, filters, invalid_filters):
+        """
+        Records one frame, given its observations, the filter bank, and a mask over the
+        bank of the filters which are being removed in this frame.
+        """
+        flags = filters.is_duplicate * np.uint8(_DUPLICATE) + \
+            np.asarray(invalid_filters) * np.uint8(_INVALID)
+        self._write(
+            [np.array([o.centroid for o in observations]),
+             np.array([o.covariance for o in observations])],
+            [filters.ids, filters.age, filters.last_observed, filters.last_observation,
+             filters.x, filters.P, flags],
+        )
+
+    def append(self, record):
+        """Records one frame given as a dict, in the format of `track(..., debug=True)`."""
+        observations = record['observations']
+        filters = [
+            (_id, f, invalid)
+            for invalid, key in ((False, 'filters'), (True, 'invalid_filters'))
+            for _id, f in record[key].items()
+        ]
+        self._write(
+            [np.array([o['centroid'] for o in observations]),
+             np.array([o['cov'] for o in observations])],
+            [np.array([int(_id) for _id, _, _ in filters]),
+             np.array([f['age'] for _, f, _ in filters]),
+             np.array([f['last_observed'] for _, f, _ in filters]),
+             np.array([f['last_observation'] for _, f, _ in filters]),
+             np.array([f['x'] for _, f, _ in filters]),
+             np.array([f['P'] for _, f, _ in filters]),
+             np.array([f['is_duplicate'] * _DUPLICATE + invalid * _INVALID
+                       for _, f, invalid in filters])],
+        )
+
+    def _write(self, observation_columns, filter_columns):
+        num_observations = len(observation_columns[0])
+        num_filters = len(filter_columns[0])
+        chunks = [np.array([num_observations, num_filters], dtype=_COUNTS).tobytes()]
+        for columns, values, n in ((_OBSERVATION_COLUMNS, observation_columns, num_observations),
+                                   (_FILTER_COLUMNS, filter_columns, num_filters)):
+            for (_, dtype, shape), column in zip(columns, values):
+                chunks.append(np.asarray(column, dtype=dtype).reshape((n,) + shape).tobytes())
+        body = b''.join(chunks)
+
+        self._offsets.append(self._file.tell())
+        self._file.write(np.array([len(body)], dtype=_LENGTH).tobytes())
+        self._file.write(body)
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self._offsets is None:
+            # Opened to resume, but never rewound; leave the file as it was
+            self._file.close()
+            return
+        self._file.write(np.array(self._offsets, dtype=_LENGTH).tobytes())
+        self._file.write(np.array([len(self._offsets)], dtype=_LENGTH).tobytes())
+        self._file.write(INDEX_MAGIC)
+        self._file.close()
+
+
+class DebugReader:
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self.frame_step, self._start = _read_header(self._file, path)
+        self._offsets = self._read_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return [self[i] for i in range(*n.indices(len(self)))]
+        return _decode(self.columns(n))
+
+    def columns(self, n):
+        """
+        Returns frame n as a dict of arrays, one row per observation ('centroid', 'cov')
+        or per filter ('ids', 'age', 'last_observed', 'last_observation', 'x', 'P',
+        'is_duplicate', 'invalid'), without making a dict for each one.
+        """
+        self._file.seek(self._offsets[n])
+        length = int(np.frombuffer(self._file.read(_LENGTH.itemsize), dtype=_LENGTH)[0])
+        return _columns(self._file.read(length))
+
+    def __iter__(self):
+        return (self[n] for n in range(len(self)))
+
+    def _read_index(self):
+        end = self._file.seek(0, os.SEEK_END)
+        footer = _LENGTH.itemsize + len(INDEX_MAGIC)
+        if end >= self._start + footer:
+            self._file.seek(end - footer)
+            count = int(np.frombuffer(self._file.read(_LENGTH.itemsize), dtype=_LENGTH)[0])
+            if self._file.read(len(INDEX_MAGIC)) == INDEX_MAGIC:
+                self._file.seek(end - footer - count * _LENGTH.itemsize)
+                return np.frombuffer(
+                    self._file.read(count * _LENGTH.itemsize), dtype=_LENGTH).tolist()
+
+        # No index; the writer didn't finish. Use whatever complete records there are.
+        return _scan_records(self._file, self._start, end)
+
+
+def _read_header(file, path):
+    """Reads the header of a debug output file, and returns its frame step and length."""
+    magic = file.read(len(MAGIC))
+    if magic == _MAGIC_V1:
+        return 1, len(_MAGIC_V1)
+    if magic != MAGIC:
+        file.close()
+        raise ValueError(f'{path} is not a debug output file')
+    step = int(np.frombuffer(file.read(_LENGTH.itemsize), dtype=_LENGTH)[0])
+    return step, len(MAGIC) + _LENGTH.itemsize
+
+
+def _scan_records(file, start, end, limit=None):
+    """
+    Returns the offsets of the complete records in a file, from the first at `start`,
+    skipping from one to the next.
+    """
+    offsets = []
+    offset = start
+    while offset + _LENGTH.itemsize <= end and (limit is None or len(offsets) < limit):
+        file.seek(offset)
+        length = int(np.frombuffer(file.read(_LENGTH.itemsize), dtype=_LENGTH)[0])
+        if offset + _LENGTH.itemsize + length > end:
+            break
+        offsets.append(offset)
+        offset += _LENGTH.itemsize + length
+    return offsets
+
+
+def _columns(body):
+    num_observations, num_filters = np.frombuffer(body, dtype=_COUNTS, count=2).tolist()
+    position = 2 * _COUNTS.itemsize
+    columns = {}
+    for column_types, n in ((_OBSERVATION_COLUMNS, num_observations),
+                            (_FILTER_COLUMNS, num_filters)):
+        for name, dtype, shape in column_types:
+            count = n * int(np.prod(shape))
+            columns[name] = np.frombuffer(
+                body, dtype=dtype, count=count, offset=position).reshape((n,) + shape)
+            position += count * dtype.itemsize
+
+    flags = columns.pop('flags')
+    columns['is_duplicate'] = (flags & _DUPLICATE).astype(bool)
+    columns['invalid'] = (flags & _INVALID).astype(bool)
+    return columns
+
+
+def _decode(columns):
+    def dump(i):
+        return {
+            'age': int(columns['age'][i]),
+            'last_observed': int(columns['last_observed'][i]),
+            'last_observation': int(columns['last_observation'][i]),
+            'is_duplicate': bool(columns['is_duplicate'][i]),
+            'x': columns['x'][i].tolist(),
+            'P': columns['P'][i].tolist(),
+        }
+
+    invalid = columns['invalid']
+    ids = columns['ids'].tolist()
+    return {
+        'observations': [
+            {'centroid': centroid, 'cov': cov}
+            for centroid, cov in zip(columns['centroid'].tolist(), columns['cov'].tolist())
+        ],
+        'filters': {ids[i]: dump(i) for i in np.flatnonzero(~invalid)},
+        'invalid_filters': {ids[i]: dump(i) for i in np.flatnonzero(invalid)},
+    }
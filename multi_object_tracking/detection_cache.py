@@ -0,0 +1,177 @@
+"""
+A persistent cache of per-frame observations, so that tuning the association, update or
+tracking parameters doesn't mean decoding the video and recomputing the foreground and
+detections every time.
+
+Entries are keyed by a hash of the video's contents, the range (and crop) of frames, the
+values of the PP_* and OBS_* parameters, which are the only ones detection depends on,
+and the decoder and stride if they aren't the defaults. Each entry is two files:
+`<key>.observations`, the raw float64 rows (x, y, cov_xx, cov_xy, cov_yx, cov_yy) of all
+observations in frame order, which is read through a memory map, and `<key>.index.npy`,
+the offset of each frame's first row. The index is written last, so an entry only exists
+once it's complete. Its modification time doubles as the last time the entry was used,
+and the least recently used entries are deleted whenever the cache grows beyond
+`max_bytes`.
+"""
+import glob
+import hashlib
+import io
+import json
+import os
+
+import numpy as np
+
+from . import params
+from .observation import Observation
+
+DEFAULT_MAX_BYTES = 10 * 2**30
+
+_ROW = 6
+_HASHES = 'hashes.json'
+
+
+class DetectionCache:
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, filename, start=0, end=None, roi=None, config=None, decoder='opencv',
+            stride=1):
+        detection_params = {
+            name: value for name, value in params.resolve(config).values().items()
+            if name.startswith(('PP_', 'OBS_'))
+        }
+        description = [self._content_hash(filename), start, end, roi, detection_params]
+        if decoder != 'opencv':
+            # Decoders convert to greyscale slightly differently
+            description.append(decoder)
+        if stride != 1:
+            description.append(['stride', stride])
+        description = json.dumps(description, sort_keys=True)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def _content_hash(self, filename):
+        # Hashing a long video takes a while, so remember the hash for as long as the
+        # file's size and modification time stay the same.
+        hashes_path = os.path.join(self.directory, _HASHES)
+        try:
+            with open(hashes_path) as f:
+                hashes = json.load(f)
+        except (FileNotFoundError, ValueError):
+            hashes = {}
+
+        stat = os.stat(filename)
+        path = os.path.abspath(filename)
+        known = hashes.get(path)
+        if known is not None and known['size'] == stat.st_size and \
+                known['mtime_ns'] == stat.st_mtime_ns:
+            return known['sha256']
+
+        sha256 = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                sha256.update(chunk)
+        hashes[path] = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                            sha256=sha256.hexdigest())
+        _write_atomically(hashes_path, json.dumps(hashes).encode())
+        return hashes[path]['sha256']
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return f'{base}.observations', f'{base}.index.npy'
+
+    def get(self, key, first=0):
+        """
+        Returns a generator of the cached list of observations in each frame, starting at
+        frame `first` of the range, or None if there's no entry for `key`.
+        """
+        observations_path, index_path = self._paths(key)
+        try:
+            index = np.load(index_path)
+        except FileNotFoundError:
+            return None
+        os.utime(index_path)
+        return _read(observations_path, index, first)
+
+    def record(self, key, detections):
+        """
+        Yields the lists of observations from `detections`, and stores them under `key`
+        once `detections` has been exhausted. If it stops early (it raises, or the
+        generator is closed before the end), nothing is stored.
+        """
+        observations_path, index_path = self._paths(key)
+        temp_path = f'{observations_path}.{os.getpid()}.tmp'
+        index = [0]
+        try:
+            with open(temp_path, 'wb') as f:
+                for observations in detections:
+                    rows = np.empty((len(observations), _ROW))
+                    for row, obs in zip(rows, observations):
+                        row[:2] = obs.centroid
+                        row[2:] = obs.covariance.ravel()
+                    f.write(rows.tobytes())
+                    index.append(index[-1] + len(observations))
+                    yield observations
+            os.replace(temp_path, observations_path)
+        finally:
+            _remove_if_exists(temp_path)
+
+        _write_atomically(index_path, _npy_bytes(np.array(index, dtype=np.int64)))
+        self.evict()
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache fits in `max_bytes`."""
+        entries = []
+        for index_path in glob.glob(os.path.join(self.directory, '*.index.npy')):
+            key = os.path.basename(index_path)[:-len('.index.npy')]
+            paths = self._paths(key)
+            try:
+                size = sum(os.path.getsize(path) for path in paths)
+                entries.append((os.path.getmtime(index_path), size, paths))
+            except FileNotFoundError:
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, paths in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for path in reversed(paths):
+                _remove_if_exists(path)
+            total -= size
+
+
+def _read(observations_path, index, first):
+    if index[-1] == 0:
+        rows = np.empty((0, _ROW))
+    else:
+        rows = np.memmap(observations_path, dtype=np.float64, mode='r').reshape((-1, _ROW))
+    for frame_start, frame_end in zip(index[first:-1], index[first + 1:]):
+        frame_rows = np.array(rows[frame_start:frame_end])
+        yield [
+            Observation(row[:2], row[2:].reshape((2, 2)))
+            for row in frame_rows
+        ]
+
+
+def _npy_bytes(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array)
+    return buffer.getvalue()
+
+
+def _write_atomically(path, data):
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    finally:
+        _remove_if_exists(temp_path)
+
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
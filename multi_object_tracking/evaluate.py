@@ -1,131 +1,116 @@
 import argparse
-import glob
+import concurrent.futures
+import contextlib
+import csv
+import itertools
 import json
 import os
-import re
+import random
 import sys
+import time
 
 import numpy as np
 import scipy.sparse
 import scipy.spatial
 
 from . import params
-from .track import track
-
-OFFSETS = {
-    1: np.array([0, 0]),
-    2: np.array([640, 0]),
-    3: np.array([0, 512]),
-    4: np.array([640, 512]),
-}
+from .detection_cache import DetectionCache
+from .labels import LabelIndex
+from .track import capture_record, detect, track, track_observations
 
 
 class BadVideoException(Exception):
     pass
 
 
-def load_labels(basename, frame_num):
-    labels = []
-    found = False
-    frame_num = frame_num + 1  # frame number in file name is 1-indexed
-
-    for i in (1, 2, 3, 4):
-        filename = f'{basename}_{frame_num:04d}_{i}_label.json'
-        if not os.path.isfile(filename):
-            filename = f'{basename}_{frame_num:04d}_{i}_labelbasic.json'
-        try:
-            with open(filename) as f:
-                data = json.load(f)
-                labels.extend([
-                    np.mean(s['points'], axis=0) + OFFSETS[i]
-                    for s in data['shapes']
-                ])
-                found = True
-        except FileNotFoundError:
-            pass
-
-    return labels, found
-
-
-def compute_stats(predictions, labels):
-    predictions_tree = scipy.spatial.cKDTree(predictions)
-    labels_tree = scipy.spatial.cKDTree(labels)
-
-    l_to_ps = labels_tree.query_ball_tree(
-        predictions_tree, params.EVAL_MATCH_PIXEL_THRESHOLD)
-    indices = []
-    indptr = [0]
-    for ps in l_to_ps:
-        indices.extend(ps)
-        indptr.append(len(indices))
-    data = np.ones((len(indices),))
-    matrix = scipy.sparse.csr_matrix((data, indices, indptr))
+def count_matches(predictions, prediction_frames, labels, label_frames, threshold):
+    """
+    Returns the number of labels matched to predictions, where a label and a prediction
+    can match if they're in the same frame and within `threshold` of each other, and each
+    one matches at most once. Every frame is matched in one go: the frame number is used
+    as a third coordinate, scaled so that points in different frames are always too far
+    apart to match, and the matching of the resulting block diagonal graph is the union
+    of the per-frame matchings.
+    """
+    if len(predictions) == 0 or len(labels) == 0:
+        return 0
+    scale = 2. * threshold + 1.
+    predictions_tree = scipy.spatial.cKDTree(
+        np.column_stack([predictions, prediction_frames * scale]))
+    labels_tree = scipy.spatial.cKDTree(np.column_stack([labels, label_frames * scale]))
+
+    pairs = labels_tree.sparse_distance_matrix(
+        predictions_tree, threshold, output_type='ndarray')
+    if len(pairs) == 0:
+        return 0
+    matrix = scipy.sparse.csr_matrix(
+        (np.ones((len(pairs),)), (pairs['i'], pairs['j'])),
+        shape=(len(labels), len(predictions)))
     best_matches = scipy.sparse.csgraph.maximum_bipartite_matching(
         matrix, perm_type='column')
+    return np.count_nonzero(best_matches >= 0)
 
-    matches = np.count_nonzero(best_matches >= 0)
-
-    fp = len(predictions) - matches
-    fn = len(labels) - matches
-    return dict(
-        matches=matches,
-        false_positives=fp,
-        false_negatives=fn,
-    )
-
-
-def evaluate_video(filename, labels_dir, use_filters, start, end):
-    labels_base = os.path.join(
-        labels_dir,
-        os.path.splitext(os.path.basename(filename))[0]
-    )
 
+def frame_range(labels, start, end, config=None):
+    """
+    Fills in whichever of `start` and `end` is None from the range of labelled frames in
+    the `LabelIndex` `labels`, padded by the background window. An `end` of -1 means the
+    end of the video, None.
+    """
+    config = params.resolve(config)
     if start is None or end is None:
-        label_names = glob.glob(f'{labels_base}_*_label*.json')
-        pat = re.compile('^{prefix}_([0-9]*)_'.format(prefix=re.escape(labels_base)))
-        frame_nums = set(
-            int(re.match(pat, name).groups()[0], base=10) - 1
-            for name in label_names
-        )
-        if len(frame_nums) == 0:
+        if len(labels) == 0:
             raise BadVideoException('No labels found')
 
         if start is None:
-            start = max(0, min(frame_nums) - params.PP_NUM_FRAMES_IN_MAX_BUFFER)
+            start = max(0, int(labels.frames[0]) - config.PP_NUM_FRAMES_IN_MAX_BUFFER)
         if end is None:
-            end = max(frame_nums) + params.PP_NUM_FRAMES_IN_MAX_BUFFER
+            end = int(labels.frames[-1]) + config.PP_NUM_FRAMES_IN_MAX_BUFFER
 
         print(f'Auto-detected beginning and end of labels; using start {start}, end {end}')
 
     if end == -1:
         end = None
+    return start, end
+
+
+def evaluate_video(filename, labels_dir, use_filters, start, end, detection_cache=None,
+                   config=None):
+    config = params.resolve(config)
+    labels = LabelIndex.load(labels_dir, filename)
+    start, end = frame_range(labels, start, end, config)
 
     try:
-        _, debug_data = track(filename, debug=True, start=start, end=end)
+        _, captured = track(filename, start=start, end=end, detection_cache=detection_cache,
+                            config=config, capture_frames=set(labels.frames.tolist()))
     except Exception as e:
         raise BadVideoException(e)
-    end = end or (start + len(debug_data))
 
-    matches = 0
-    fp = 0
-    fn = 0
+    key = 'filters' if use_filters else 'observations'
+    predictions = {frame: positions[key] for frame, positions in captured.items()}
+    return score(predictions, labels, config)
 
-    for i in range(start, end):
-        labels, found = load_labels(labels_base, i)
-        if not found:
-            continue
-        predictions = [
-                f['x'][:2] for f in debug_data[i - start]['filters'].values()
-            ] \
-            if use_filters \
-            else [o['centroid'] for o in debug_data[i - start]['observations']]
-        frame_stats = compute_stats(
-            predictions,
-            labels,
-        )
-        matches += frame_stats['matches']
-        fp += frame_stats['false_positives']
-        fn += frame_stats['false_negatives']
+
+def score(predictions, labels, config=None):
+    """
+    Takes a dict from frame number to an array of the predicted positions in that frame,
+    and a `LabelIndex`, and returns the overall stats of the labelled frames among them.
+    """
+    config = params.resolve(config)
+    frames = [frame for frame in labels.frames.tolist() if frame in predictions]
+    frame_predictions = [predictions[frame] for frame in frames]
+    prediction_frames = np.repeat(frames, [len(p) for p in frame_predictions])
+    prediction_points = (
+        np.concatenate(frame_predictions) if frame_predictions else np.empty((0, 2)))
+
+    label_frames = np.repeat(labels.frames, np.diff(labels.offsets))
+    scored = np.isin(label_frames, frames)
+    label_frames, label_points = label_frames[scored], labels.points[scored]
+
+    matches = count_matches(prediction_points, prediction_frames, label_points, label_frames,
+                            config.EVAL_MATCH_PIXEL_THRESHOLD)
+    fp = len(prediction_points) - matches
+    fn = len(label_points) - matches
 
     precision = float('inf') if (matches + fp) == 0 else matches / (matches + fp)
     recall = float('inf') if (matches + fn) == 0 else matches / (matches + fn)
@@ -139,11 +124,9 @@ def evaluate_video(filename, labels_dir, use_filters, start, end):
     )
 
 
-def evaluate_all(list_of_videos, use_filters, start, end):
-    matches = 0
-    false_positives = 0
-    false_negatives = 0
-
+def read_video_list(list_of_videos):
+    """Reads lines like <path-to-video>,<path-to-labels-dir> into (video, labels_dir) pairs."""
+    videos = []
     for line in list_of_videos.readlines():
         line = line.strip()
         if not line:
@@ -154,10 +137,24 @@ def evaluate_all(list_of_videos, use_filters, start, end):
         except ValueError:
             print(f'Bad line, skipping: {line}')
             continue
+        videos.append((video, labels_dir))
+
+    if list_of_videos is not sys.stdin:
+        list_of_videos.close()
+    return videos
+
 
+def evaluate_all(list_of_videos, use_filters, start, end, detection_cache=None):
+    matches = 0
+    false_positives = 0
+    false_negatives = 0
+    if detection_cache is not None:
+        detection_cache = DetectionCache(detection_cache)
+
+    for video, labels_dir in read_video_list(list_of_videos):
         print(f'Stats for {os.path.basename(video)}:')
         try:
-            stats = evaluate_video(video, labels_dir, use_filters, start, end)
+            stats = evaluate_video(video, labels_dir, use_filters, start, end, detection_cache)
         except BadVideoException as e:
             print(e)
             raise e
@@ -172,9 +169,6 @@ def evaluate_all(list_of_videos, use_filters, start, end):
         false_positives += stats['false_positives']
         false_negatives += stats['false_negatives']
 
-    if list_of_videos is not sys.stdin:
-        list_of_videos.close()
-
     print('--------------')
 
     if max(matches, false_positives, false_negatives) == 0:
@@ -191,6 +185,147 @@ def evaluate_all(list_of_videos, use_filters, start, end):
     return 0
 
 
+def sweep_configs(spec, base):
+    """
+    Expands a sweep spec into a list of `params.Params`, each one `base` with some values
+    replaced. The spec is a dict, either
+
+        {"grid": {"NAME": [value, ...], ...}}
+
+    for every combination of the listed values, or
+
+        {"random": {"NAME": [low, high] or {"choices": [value, ...]}, ...},
+         "samples": 20, "seed": 0}
+
+    for that many samples, each value drawn uniformly from a range (of integers, if both
+    ends are integers) or from a list of choices.
+    """
+    names = list(spec.get('grid') or spec.get('random') or {})
+    unknown = [name for name in names if name not in base.values()]
+    if unknown:
+        raise ValueError(f'Unknown parameters in sweep: {", ".join(unknown)}')
+
+    if 'grid' in spec:
+        return [
+            base.replace(**dict(zip(names, values)))
+            for values in itertools.product(*(spec['grid'][name] for name in names))
+        ]
+
+    rng = random.Random(spec.get('seed'))
+
+    def draw(choices):
+        if isinstance(choices, dict):
+            return rng.choice(choices['choices'])
+        low, high = choices
+        if isinstance(low, int) and isinstance(high, int):
+            return rng.randint(low, high)
+        return rng.uniform(low, high)
+
+    return [
+        base.replace(**{name: draw(spec['random'][name]) for name in names})
+        for _ in range(spec['samples'])
+    ]
+
+
+def _detection_values(config):
+    return tuple(sorted(
+        (name, json.dumps(value)) for name, value in config.values().items()
+        if name.startswith(('PP_', 'OBS_'))
+    ))
+
+
+def _detect_labelled_video(video, labels, start, end, config):
+    """Detects the observations in a video over its labelled range."""
+    start, end = frame_range(labels, start, end, config)
+    began = time.perf_counter()
+    detections = list(detect(video, start, end, config=config))
+    seconds = time.perf_counter() - began
+    return dict(start=start, detections=detections, labels=labels, seconds=seconds)
+
+
+def _evaluate_detections(detected, use_filters, config):
+    """Tracks precomputed observations with `config`, and scores the labelled frames."""
+    began = time.perf_counter()
+    labelled = set(detected['labels'].frames.tolist())
+    key = 'filters' if use_filters else 'observations'
+    predictions = {}
+    frames = track_observations(detected['detections'], config=config)
+    for frame_num, (observations, filters, invalid_filters) in enumerate(
+            frames, detected['start']):
+        if frame_num in labelled:
+            predictions[frame_num] = capture_record(observations, filters, invalid_filters)[key]
+    seconds = time.perf_counter() - began
+    return score(predictions, detected['labels'], config), seconds
+
+
+def sweep(list_of_videos, spec, use_filters, start, end, workers=None, out=sys.stdout):
+    """
+    Evaluates every configuration of a sweep spec (see `sweep_configs`), based on the
+    parameters currently in effect, and writes a CSV table of the swept values, overall
+    stats, and seconds spent on detection and on tracking.
+
+    Each video is decoded and detected only once per distinct set of PP_* and OBS_*
+    values, and the observations are shared by all configurations that only differ in
+    the tracking parameters. Both detection and tracking runs are spread over a pool
+    of `workers` processes (by default one per CPU).
+    """
+    videos = read_video_list(list_of_videos)
+    configs = sweep_configs(spec, params.Params())
+    names = list(spec.get('grid') or spec.get('random'))
+
+    groups = {}
+    for i, config in enumerate(configs):
+        groups.setdefault(_detection_values(config), []).append(i)
+
+    if not videos:
+        print('No videos found, exiting.')
+        return 1
+    labels = [LabelIndex.load(labels_dir, video) for video, labels_dir in videos]
+
+    # Every configuration is detected with the first one of its group
+    leaders = {i: indices[0] for indices in groups.values() for i in indices}
+    detection_tasks = [
+        (indices[0], k) for indices in groups.values() for k in range(len(videos))]
+    tracking_tasks = [(i, k) for i in range(len(configs)) for k in range(len(videos))]
+
+    workers = os.cpu_count() if workers is None else workers
+    with contextlib.ExitStack() as stack:
+        mapper = map
+        if workers > 1:
+            mapper = stack.enter_context(concurrent.futures.ProcessPoolExecutor(workers)).map
+
+        detected = dict(zip(detection_tasks, mapper(
+            _detect_labelled_video,
+            [videos[k][0] for _, k in detection_tasks],
+            [labels[k] for _, k in detection_tasks],
+            itertools.repeat(start),
+            itertools.repeat(end),
+            [configs[i] for i, _ in detection_tasks])))
+        results = dict(zip(tracking_tasks, mapper(
+            _evaluate_detections,
+            [detected[leaders[i], k] for i, k in tracking_tasks],
+            itertools.repeat(use_filters),
+            [configs[i] for i, _ in tracking_tasks])))
+
+    writer = csv.writer(out)
+    writer.writerow(names + ['matches', 'false_positives', 'false_negatives', 'precision',
+                             'recall', 'detection_seconds', 'tracking_seconds'])
+    for i, config in enumerate(configs):
+        config_results = [results[i, k] for k in range(len(videos))]
+        matches = sum(stats['matches'] for stats, _ in config_results)
+        fp = sum(stats['false_positives'] for stats, _ in config_results)
+        fn = sum(stats['false_negatives'] for stats, _ in config_results)
+        detection_seconds = sum(detected[leaders[i], k]['seconds'] for k in range(len(videos)))
+        writer.writerow([getattr(config, name) for name in names] + [
+            matches, fp, fn,
+            float('inf') if (matches + fp) == 0 else matches / (matches + fp),
+            float('inf') if (matches + fn) == 0 else matches / (matches + fn),
+            f'{detection_seconds:.3f}',
+            f'{sum(seconds for _, seconds in config_results):.3f}',
+        ])
+    return 0
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser('Generate evaluation metrics.')
     parser.add_argument(
@@ -207,9 +342,28 @@ if __name__ == '__main__':
         '-e', '--end', default=None, type=int,
         help='Frame number at which to stop. Omit to auto-detect based on labels. '
              'Use -1 to go until the end of the video.')
+    parser.add_argument(
+        '--detection-cache',
+        help='If present, cache the observations in each video in this directory, so that '
+             'evaluating different tracking parameters skips detection.')
     parser.add_argument(
         '--params', help='Override the default model parameters by passing a file.')
+    parser.add_argument(
+        '--sweep', type=argparse.FileType(),
+        help='Instead of evaluating one set of parameters, evaluate every configuration of '
+             'the grid or random search in this JSON file, and write a table of results.')
+    parser.add_argument(
+        '--sweep-out', default=sys.stdout, type=argparse.FileType('w'),
+        help='Path to write the sweep results to, as CSV. (Standard output by default.)')
+    parser.add_argument(
+        '-w', '--workers', default=None, type=int,
+        help='Number of processes to run a sweep in. (Default one per CPU.)')
     args, _ = parser.parse_known_args()
     args = vars(args)
     params.init(args.pop('params'))
+    sweep_spec, sweep_out, workers = args.pop('sweep'), args.pop('sweep_out'), args.pop('workers')
+    if sweep_spec is not None:
+        if args.pop('detection_cache') is not None:
+            parser.error('--detection-cache is not used with --sweep')
+        sys.exit(sweep(spec=json.load(sweep_spec), workers=workers, out=sweep_out, **args))
     sys.exit(evaluate_all(**args))
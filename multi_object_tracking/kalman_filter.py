@@ -1,67 +1,243 @@
 import itertools
 
-import filterpy.common
-from filterpy.stats import logpdf
 import numpy as np
 
 from . import params
+from .spatial_index import SpatialIndex
+
+# Constant velocity model with state [x, y, dx, dy]; only the position is observed.
+H = np.array([[1., 0., 0., 0.], [0., 1., 0., 0.]])
+
+
+def transition_matrix(dt=1.):
+    F = np.eye(4)
+    F[0, 2] = F[1, 3] = dt
+    return F
+
+
+def process_noise(dt=1., var=3.):
+    """
+    Discrete white noise acceleration model; same as filterpy's
+    `Q_discrete_white_noise(dim=2, block_size=2, order_by_dim=False)`.
+    """
+    block = np.array([[.25 * dt**4, .5 * dt**3], [.5 * dt**3, dt**2]]) * var
+    return np.kron(block, np.eye(2))
+
+
+def accumulated_process_noise(steps=1, var=3.):
+    """
+    The process noise of `steps` one-frame predictions in a row, sum F^i Q F^iᵀ over
+    i < steps with F and Q for one frame, so that one prediction over `steps` frames is
+    the same as that many one-frame predictions. Equal to `process_noise()` for one step.
+    """
+    i = np.arange(steps)
+    block = np.array([[np.sum(.25 + i + i**2), np.sum(.5 + i)],
+                      [np.sum(.5 + i), steps]]) * var
+    return np.kron(block, np.eye(2))
 
 
 def update_covariance(observation):
     return 0.5 * observation.covariance + np.eye(2)
 
 
-class KalmanConstVelFilter:
+def _live(name):
+    return property(lambda self: getattr(self, name)[:self.n])
+
+
+class KalmanFilterBank:
+    """
+    A collection of constant velocity Kalman filters, stored as a structure of arrays
+    so that predicting and updating all of them is a handful of batched NumPy operations.
+
+    Filters are addressed by their row index, which is only valid until the next call
+    to `remove`. Every filter also has an id, which is never reused. New filters are
+    initialised with the parameters in `config` (see `params.Params`).
+
+    Each `predict` steps the filters `dt` frames ahead, as if by that many one-frame
+    predictions. Velocities are always in pixels per frame, so with dt > 1 (tracking
+    every dt-th frame) they mean the same thing.
+
+    The bank keeps a `spatial_index.SpatialIndex` of the filters' positions up to date
+    as they're predicted, updated, added and removed, for `neighbours` and `close_pairs`.
+    So states must only be changed through the bank's methods.
+    """
     id_iter = itertools.count()
 
-    def __init__(self, idx_observation, *args, **kwargs):
-        kf = filterpy.common.kinematic.kinematic_kf(
-            dim=2,
-            order=1,
-            order_by_dim=False
-        )
-        idx, observation = idx_observation
-        kf.x[:2] = np.reshape(observation.centroid, (2, 1))
-        kf.x[2:] = np.array([[0.], [0.]])
-        kf.P = np.diag(params.KF_INITIAL_DIAG_COV)
-        kf.P[:2, :2] = update_covariance(observation)
-        kf.R = np.diag([1.0, 1.0])
-        kf.Q = filterpy.common.discretization.Q_discrete_white_noise(
-            dim=2, block_size=2, order_by_dim=False, var=3.)
-        self._kf = kf
-        self.age = 0
-        self.last_observed = 0
-        self.last_observation = idx
-        self.is_duplicate = False
-        self.id = next(KalmanConstVelFilter.id_iter)
+    def __init__(self, capacity=64, config=None, dt=1.):
+        self.n = 0
+        self.config = params.resolve(config)
+        self.index = SpatialIndex()
+        self.dt = dt
+        self._F = transition_matrix(dt)
+        self._Q = process_noise() if dt == 1 else accumulated_process_noise(dt)
+        self._x = np.empty((capacity, 4))
+        self._P = np.empty((capacity, 4, 4))
+        self._ids = np.empty((capacity,), dtype=np.int64)
+        self._age = np.empty((capacity,), dtype=np.int64)
+        self._last_observed = np.empty((capacity,), dtype=np.int64)
+        self._last_observation = np.empty((capacity,), dtype=np.int64)
+        self._is_duplicate = np.empty((capacity,), dtype=bool)
+
+    _COLUMNS = ('_x', '_P', '_ids', '_age', '_last_observed', '_last_observation',
+                '_is_duplicate')
+
+    x = _live('_x')
+    P = _live('_P')
+    ids = _live('_ids')
+    age = _live('_age')
+    last_observed = _live('_last_observed')
+    last_observation = _live('_last_observation')
+    is_duplicate = _live('_is_duplicate')
+
+    def __len__(self):
+        return self.n
+
+    def _reserve(self, n):
+        capacity = len(self._x)
+        if n <= capacity:
+            return
+        while capacity < n:
+            capacity *= 2
+        for name in self._COLUMNS:
+            old = getattr(self, name)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.n] = old[:self.n]
+            setattr(self, name, new)
+
+    def add(self, idx_observations):
+        """
+        Makes a new filter for each (index, observation) pair, initialised at the
+        observation's centroid with zero velocity. Returns the new filters' rows.
+        """
+        idx_observations = list(idx_observations)
+        start, end = self.n, self.n + len(idx_observations)
+        self._reserve(end)
+        new = slice(start, end)
+        self.n = end
+
+        for row, (idx, obs) in enumerate(idx_observations, start):
+            self._x[row, :2] = obs.centroid
+            self._P[row] = np.diag(self.config.KF_INITIAL_DIAG_COV)
+            self._P[row, :2, :2] = update_covariance(obs)
+            self._last_observation[row] = idx
+        self._x[new, 2:] = 0.
+        self._ids[new] = [next(KalmanFilterBank.id_iter) for _ in range(start, end)]
+        self._age[new] = 0
+        self._last_observed[new] = 0
+        self._is_duplicate[new] = False
+        self.index.add(self._x[new, :2])
+        return np.arange(start, end)
+
+    def remove(self, mask):
+        """Drops the filters where `mask` is True, keeping the others in order."""
+        keep = ~np.asarray(mask, dtype=bool)
+        n = np.count_nonzero(keep)
+        for name in self._COLUMNS:
+            column = getattr(self, name)
+            column[:n] = column[:self.n][keep]
+        self.n = n
+        self.index.remove(keep)
 
     def predict(self):
-        self._kf.predict()
-        self.last_observed += 1
-        self.age += 1
+        F = self._F
+        self.x[...] = self.x @ F.T
+        self.P[...] = F @ self.P @ F.T + self._Q
+        self.last_observed[...] += 1
+        self.age[...] += 1
+        self.index.move(slice(0, self.n), self.mean())
 
     def mean(self):
-        return np.squeeze(self._kf.measurement_of_state(self._kf.x))
-
-    def update(self, observation):
-        idx, obs = observation
-        self._kf.update(obs.centroid, R=update_covariance(obs))
-        self.last_observed = 0
-        self.last_observation = idx
-
-    def dist(self, observation):
-        # negative log likelihood (so that smaller is better)
-        kf = self._kf
-        residual = observation.centroid - self.mean()
-        S = np.dot(kf.H, np.dot(kf.P, kf.H.T)) + observation.covariance
-        return -logpdf(x=residual, cov=S)
-
-    def dump(self):
+        """Predicted positions, N×2."""
+        return self.x[:, :2]
+
+    def covariance(self):
+        """Position covariances, N×2×2."""
+        return self.P[:, :2, :2]
+
+    def update(self, rows, idx_observations):
+        """
+        Updates the filters at `rows` with the corresponding (index, observation) pairs.
+        Each row must appear at most once.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0:
+            return
+        indices = np.array([idx for idx, _ in idx_observations])
+        z = np.array([obs.centroid for _, obs in idx_observations])
+        Rs = np.array([update_covariance(obs) for _, obs in idx_observations])
+
+        x, P = self._x[rows], self._P[rows]
+        y = z - x @ H.T
+        PHT = P @ H.T
+        S = H @ PHT + Rs
+        K = PHT @ np.linalg.inv(S)
+        x = x + (K @ y[:, :, None])[:, :, 0]
+
+        # Joseph form, as in filterpy
+        I_KH = np.eye(4) - K @ H
+        P = I_KH @ P @ np.swapaxes(I_KH, 1, 2) + K @ Rs @ np.swapaxes(K, 1, 2)
+
+        self._x[rows] = x
+        self._P[rows] = P
+        self.index.move(rows, x[:, :2])
+        self._last_observed[rows] = 0
+        self._last_observation[rows] = indices
+
+    def dist(self, rows, centroids, covariances):
+        """
+        Negative log likelihood (so that smaller is better) of each observation, given by
+        its centroid and covariance, under the filter in the corresponding row. Uses the
+        closed form inverse and determinant of the 2×2 innovation covariance.
+        """
+        residual = centroids - self._x[rows, :2]
+        S = self._P[rows, :2, :2] + covariances
+        a, b, c, d = S[:, 0, 0], S[:, 0, 1], S[:, 1, 0], S[:, 1, 1]
+        det = a * d - b * c
+        r0, r1 = residual[:, 0], residual[:, 1]
+        mahalanobis = (d * r0 * r0 - (b + c) * r0 * r1 + a * r1 * r1) / det
+        return 0.5 * (mahalanobis + np.log(det)) + np.log(2 * np.pi)
+
+    def neighbours(self, points, radius):
+        """
+        Returns (rows, indices), in no particular order, for every filter whose position
+        is within `radius` of `points[index]`.
+        """
+        return self.index.query_radius(self.mean(), points, radius)
+
+    def close_pairs(self, radius):
+        """
+        Returns the pairs of rows (i, j), i < j, of filters whose full states are within
+        `radius` of each other, as an N×2 array.
+        """
+        return self.index.query_pairs(self.mean(), self.x, radius)
+
+    def state(self, rows=None):
+        """
+        Returns the filters at `rows` (all of them by default) as a dict of arrays, which
+        `from_state` turns back into a bank.
+        """
+        rows = slice(0, self.n) if rows is None else rows
+        return {name[1:]: getattr(self, name)[rows] for name in self._COLUMNS}
+
+    @classmethod
+    def from_state(cls, state, config=None, dt=1.):
+        n = len(state['x'])
+        filters = cls(max(n, 64), config, dt)
+        for name in cls._COLUMNS:
+            getattr(filters, name)[:n] = state[name[1:]]
+        filters.n = n
+        return filters
+
+    def dump(self, rows=None):
+        rows = range(self.n) if rows is None else rows
         return {
-            'age': self.age,
-            'last_observed': self.last_observed,
-            'last_observation': self.last_observation,
-            'is_duplicate': self.is_duplicate,
-            'x': np.squeeze(self._kf.x).tolist(),
-            'P': self._kf.P.tolist(),
+            int(self._ids[row]): {
+                'age': int(self._age[row]),
+                'last_observed': int(self._last_observed[row]),
+                'last_observation': int(self._last_observation[row]),
+                'is_duplicate': bool(self._is_duplicate[row]),
+                'x': self._x[row].tolist(),
+                'P': self._P[row].tolist(),
+            }
+            for row in rows
         }
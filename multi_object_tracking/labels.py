@@ -0,0 +1,120 @@
+"""
+An index of the labels for a video, built by scanning its labels directory once.
+
+Label files are named like `<video>_0123_1_label.json` (or `..._labelbasic.json`), where
+the frame number is 1-indexed and the last number is the tile (1 to 4) of the 2×2 mosaic
+that the file labels. Each label is the mean of a shape's points, offset by the tile's
+corner. The parsed labels are cached next to the label files as `.<video>.labels.npz`,
+along with the names, sizes and modification times of the files they came from, so that
+the JSON files are only parsed again when they change.
+"""
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+
+OFFSETS = {
+    1: np.array([0, 0]),
+    2: np.array([640, 0]),
+    3: np.array([0, 512]),
+    4: np.array([640, 512]),
+}
+
+
+class LabelIndex:
+    """
+    The labels of every labelled frame (0-indexed), stored as one array of points with
+    `frames[k]` owning `points[offsets[k]:offsets[k + 1]]`.
+    """
+
+    def __init__(self, frames, offsets, points):
+        self.frames = frames
+        self.offsets = offsets
+        self.points = points
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, frame):
+        k = np.searchsorted(self.frames, frame)
+        if k == len(self.frames) or self.frames[k] != frame:
+            raise KeyError(frame)
+        return self.points[self.offsets[k]:self.offsets[k + 1]]
+
+    @classmethod
+    def load(cls, labels_dir, video, workers=None):
+        """
+        Indexes the labels for `video` in `labels_dir`, reading them from the cache if the
+        label files haven't changed, and otherwise parsing them in a pool of `workers`
+        processes (by default one per CPU).
+        """
+        basename = os.path.splitext(os.path.basename(video))[0]
+        files = _scan(labels_dir, basename)
+        signature = hashlib.sha256(json.dumps(
+            [(name, size, mtime) for _, _, name, size, mtime in files]).encode()).hexdigest()
+
+        cache_path = os.path.join(labels_dir, f'.{basename}.labels.npz')
+        try:
+            with np.load(cache_path) as data:
+                if str(data['signature']) == signature:
+                    return cls(data['frames'], data['offsets'], data['points'])
+        except (FileNotFoundError, KeyError, ValueError):
+            pass
+
+        paths = [os.path.join(labels_dir, name) for _, _, name, _, _ in files]
+        tiles = [tile for _, tile, _, _, _ in files]
+        workers = os.cpu_count() if workers is None else workers
+        if workers > 1 and len(paths) > 64:
+            with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+                parsed = list(executor.map(_parse, paths, tiles, chunksize=64))
+        else:
+            parsed = list(map(_parse, paths, tiles))
+
+        frame_of_file = np.array([frame for frame, _, _, _, _ in files], dtype=np.int64)
+        frames = np.unique(frame_of_file)
+        counts = np.zeros((len(frames),), dtype=np.int64)
+        np.add.at(counts, np.searchsorted(frames, frame_of_file), [len(p) for p in parsed])
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        points = np.concatenate(parsed) if parsed else np.empty((0, 2))
+        index = cls(frames, offsets, points.reshape((-1, 2)))
+
+        try:
+            with open(cache_path, 'wb') as f:
+                np.savez(f, signature=signature, frames=index.frames, offsets=index.offsets,
+                         points=index.points)
+        except OSError:
+            # The labels directory may be read only; the cache is just an optimization
+            pass
+        return index
+
+
+def _scan(labels_dir, basename):
+    """
+    Returns (frame, tile, file name, size, mtime) for the label file of each labelled
+    tile, sorted by frame and tile. Where a tile has both a `label` and a `labelbasic`
+    file, the `label` file is used.
+    """
+    pattern = re.compile(
+        '^{prefix}_([0-9]+)_([1-4])_label(basic)?\\.json$'.format(prefix=re.escape(basename)))
+    files = {}
+    with os.scandir(labels_dir) as entries:
+        for entry in entries:
+            match = pattern.match(entry.name)
+            if match is None:
+                continue
+            frame, tile = int(match.group(1), base=10) - 1, int(match.group(2))
+            if match.group(3) is not None and (frame, tile) in files:
+                continue
+            stat = entry.stat()
+            files[frame, tile] = (entry.name, stat.st_size, stat.st_mtime_ns)
+    return [(frame, tile, *files[frame, tile]) for frame, tile in sorted(files)]
+
+
+def _parse(path, tile):
+    with open(path) as f:
+        data = json.load(f)
+    points = [np.mean(s['points'], axis=0) + OFFSETS[tile] for s in data['shapes']]
+    return np.array(points, dtype=float).reshape((-1, 2))
@@ -0,0 +1,142 @@
+"""
+Counting live, from a camera, a network stream or a pipe, with bounded latency.
+
+The background model is causal (see `preprocess.CausalForeground`), so each frame's
+result is ready a small, fixed number of frames after it arrives, rather than a whole
+background window later. Frames are read on their own thread into a short queue, and
+when detection and tracking can't keep up, the oldest queued frames are dropped rather
+than letting the delay grow.
+"""
+import argparse
+import collections
+import csv
+import functools
+import sys
+import time
+
+from . import observation
+from . import params
+from . import pipeline
+from . import preprocess
+from .track import track_observations
+
+
+def track_live(frames, lookahead=2, max_queue=4, config=None):
+    """
+    Tracks an iterable of greyscale frames, such as `preprocess.stream_capture` or
+    `preprocess.stream_raw`, which is read on a background thread. For each frame that
+    isn't dropped, yields a dict with
+      'frame': its index in `frames`
+      'count': the number of valid filters
+      'ids', 'x': the ids and states of the valid filters
+      'dropped': the number of frames dropped so far
+      'latency': the seconds from the frame being read to its result being yielded
+
+    Each frame's background is the max over the PP_NUM_FRAMES_IN_MAX_BUFFER frames up
+    to `lookahead` frames after it, so results lag `lookahead` frames behind. At most
+    `max_queue` frames wait to be processed; beyond that, the oldest are dropped. A
+    dropped frame is tracked as a frame without observations, so that the filters move
+    and go stale in step with the source.
+    """
+    config = params.resolve(config)
+    background = preprocess.CausalForeground(config.PP_NUM_FRAMES_IN_MAX_BUFFER, lookahead)
+    # Timestamped on the reading thread, as each frame arrives
+    read = pipeline.latest(
+        ((index, time.perf_counter(), frame) for index, frame in enumerate(frames)),
+        max_queue)
+
+    # The indices and read times of frames which are on their way through detection
+    pending = collections.deque()
+
+    def unpack():
+        for index, read_at, frame in read:
+            pending.append((index, read_at))
+            yield frame
+
+    detections = map(functools.partial(observation.observations_from_frame, config=config),
+                     background.process(unpack()))
+
+    # For each frame given to the tracker, its index and read time, or None if dropped
+    tracked = collections.deque()
+
+    def with_dropped_frames():
+        previous = -1
+        for observations in detections:
+            index, read_at = pending.popleft()
+            for _ in range(index - previous - 1):
+                tracked.append(None)
+                yield []
+            tracked.append((index, read_at))
+            previous = index
+            yield observations
+
+    dropped = 0
+    for _, filters, invalid_filters in track_observations(with_dropped_frames(), config=config):
+        frame = tracked.popleft()
+        if frame is None:
+            dropped += 1
+            continue
+        index, read_at = frame
+        valid = ~invalid_filters
+        yield {
+            'frame': index,
+            'count': int(valid.sum()),
+            'ids': filters.ids[valid],
+            'x': filters.x[valid],
+            'dropped': dropped,
+            'latency': time.perf_counter() - read_at,
+        }
+
+
+def frame_size(value):
+    try:
+        width, height = map(int, value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Expected a size like 640x512, got {value}')
+    return width, height
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Count objects live, writing a line per frame.')
+    parser.add_argument(
+        'source',
+        help='A camera index, a stream URL, a video file, or - to read raw frames from '
+             'standard input (with --raw).')
+    parser.add_argument(
+        '--raw', type=frame_size,
+        help='Read raw 8-bit greyscale frames of this WIDTHxHEIGHT from standard input, '
+             'e.g. from ffmpeg -i $SOURCE -f rawvideo -pix_fmt gray -')
+    parser.add_argument(
+        '--lookahead', default=2, type=int,
+        help='Number of frames after each frame to include in its background, which is '
+             'also how many frames the results lag behind. (Default 2.)')
+    parser.add_argument(
+        '--queue', default=4, type=int,
+        help='Number of frames that can wait to be processed before the oldest are '
+             'dropped. (Default 4.)')
+    parser.add_argument(
+        '-o', '--out', default=sys.stdout, type=argparse.FileType('w'),
+        help='Path to write frame,count,dropped,latency_ms lines to. (Standard output by '
+             'default.)')
+    parser.add_argument(
+        '--params', help='Override the default model parameters by passing a file.')
+    args = parser.parse_args()
+    if (args.source == '-') != (args.raw is not None):
+        parser.error('Use --raw exactly when reading from standard input (-)')
+    params.init(args.params)
+
+    if args.raw is not None:
+        frames = preprocess.stream_raw(sys.stdin.buffer, *args.raw)
+    else:
+        frames = preprocess.stream_capture(
+            int(args.source) if args.source.isdigit() else args.source)
+
+    writer = csv.writer(args.out)
+    writer.writerow(['frame', 'count', 'dropped', 'latency_ms'])
+    try:
+        for result in track_live(frames, args.lookahead, args.queue):
+            writer.writerow([result['frame'], result['count'], result['dropped'],
+                             f'{result["latency"] * 1e3:.1f}'])
+            args.out.flush()
+    except KeyboardInterrupt:
+        pass
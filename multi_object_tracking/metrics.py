@@ -0,0 +1,168 @@
+"""
+Opt-in per-frame instrumentation of `track`: the wall time of each stage, and counts of
+what happened in the frame, kept in memory and optionally streamed to a CSV or JSON
+lines file as each frame finishes.
+
+Decoding, background subtraction and detection are chained generators, so each one's
+time is measured around getting its next item, which includes pulling from the stages
+before it, and the earlier stages' times are subtracted. Background subtraction reads
+ahead by up to a window of frames, so the decoding of those frames is attributed to the
+frame that triggered it.
+"""
+import array
+import csv
+import json
+import time
+
+import numpy as np
+
+STAGES = ('decode', 'foreground', 'observations', 'predict', 'associate', 'update',
+          'deduplicate')
+# The detection stages, in the order they pull from each other
+_CHAINED = ('decode', 'foreground', 'observations')
+COUNTS = ('num_observations', 'num_filters', 'num_candidates', 'num_new_filters',
+          'num_duplicates', 'num_stale_filters')
+
+# Bin edges for latency histograms, log spaced from 1 µs to 10 s
+LATENCY_BINS = np.logspace(-6, 1, 43)
+
+
+class Metrics:
+    """
+    Pass to `track` as `metrics` to record each frame. Per-frame values are in
+    `columns`: 'frame', then the seconds of each of STAGES, then each of COUNTS.
+
+    If `sink` is a path ending in `.csv`, each frame is also written there as a CSV row
+    as soon as it's done; any other path gets one JSON object per line.
+
+    Frames are numbered from `next_frame` in steps of `frame_step`, which `track` sets
+    to its stride.
+    """
+
+    def __init__(self, sink=None):
+        self.columns = {name: array.array('d') for name in ('frame',) + STAGES + COUNTS}
+        self.next_frame = 0
+        self.frame_step = 1
+        self._seconds = dict.fromkeys(STAGES, 0.)
+        self._counts = dict.fromkeys(COUNTS, 0)
+        self._lap = None
+        self._file = self._writer = None
+        if sink is not None:
+            self._file = open(sink, 'w', newline='')
+            if sink.endswith('.csv'):
+                self._writer = csv.writer(self._file)
+                self._writer.writerow(self.columns)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.columns['frame'])
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+    def timed(self, iterable, stage):
+        """
+        Yields from `iterable`, adding the time spent getting each item to `stage` of the
+        current frame.
+        """
+        iterator = iter(iterable)
+        while True:
+            began = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self._seconds[stage] += time.perf_counter() - began
+            yield item
+
+    def start(self):
+        """Starts timing the tracking stages of a frame."""
+        self._lap = time.perf_counter()
+
+    def lap(self, stage):
+        """Adds the time since `start` or the previous `lap` to `stage`."""
+        now = time.perf_counter()
+        self._seconds[stage] += now - self._lap
+        self._lap = now
+
+    def count(self, name, value):
+        self._counts[name] += int(value)
+
+    def end_frame(self):
+        """Records the current frame, and starts on the next one."""
+        seconds = self._seconds
+        # The detection stages were timed including the stages they pull from
+        for stage, upstream in zip(_CHAINED[:0:-1], _CHAINED[-2::-1]):
+            seconds[stage] -= seconds[upstream]
+        row = [self.next_frame] + [seconds[stage] for stage in STAGES] + \
+            [self._counts[name] for name in COUNTS]
+        for column, value in zip(self.columns.values(), row):
+            column.append(value)
+
+        if self._writer is not None:
+            self._writer.writerow(row)
+        elif self._file is not None:
+            self._file.write(json.dumps(dict(zip(self.columns, row))) + '\n')
+
+        self.next_frame += self.frame_step
+        self._seconds = dict.fromkeys(STAGES, 0.)
+        self._counts = dict.fromkeys(COUNTS, 0)
+
+    def array(self, name):
+        return np.frombuffer(self.columns[name], dtype=np.float64)
+
+    def totals(self):
+        """Returns the total seconds spent in each stage."""
+        return {stage: float(self.array(stage).sum()) for stage in STAGES}
+
+    def histogram(self, stage, bins=LATENCY_BINS):
+        """
+        Returns the histogram of a stage's per-frame latency, as (counts, bin edges).
+        Latencies outside the bins are counted in the first or last one.
+        """
+        return np.histogram(np.clip(self.array(stage), bins[0], bins[-1]), bins=bins)
+
+    def summary(self):
+        """
+        Returns, for each stage, the total seconds and the mean, median, 95th and 99th
+        percentile and maximum per-frame milliseconds.
+        """
+        summary = {}
+        for stage in STAGES:
+            ms = self.array(stage) * 1e3
+            if len(ms) == 0:
+                continue
+            p50, p95, p99 = np.percentile(ms, [50, 95, 99]).tolist()
+            summary[stage] = dict(seconds=float(ms.sum()) / 1e3, mean_ms=float(ms.mean()),
+                                  p50_ms=p50, p95_ms=p95, p99_ms=p99, max_ms=float(ms.max()))
+        return summary
+
+    def slowest(self, n=10):
+        """Returns the frame numbers of the `n` slowest frames, slowest first."""
+        total = sum(self.array(stage) for stage in STAGES)
+        return self.array('frame')[np.argsort(-total, kind='stable')[:n]].astype(int).tolist()
+
+
+class _Disabled:
+    """Stands in for `Metrics` when metrics are off, doing nothing."""
+
+    def start(self):
+        pass
+
+    def lap(self, stage):
+        pass
+
+    def count(self, name, value):
+        pass
+
+    def end_frame(self):
+        pass
+
+
+DISABLED = _Disabled()
@@ -2,42 +2,214 @@ from collections import namedtuple
 
 import cv2 as cv
 import numpy as np
-import scipy
 
 from . import params
 
 Observation = namedtuple('Observation', ('centroid', 'covariance'))
 
 
-def observations_from_frame(frame):
-    thresholded = (frame > params.OBS_FOREGROUND_THRESHOLD).astype(np.uint8)
-    cleaned = scipy.ndimage.binary_opening(thresholded).astype(np.uint8)
-    n, component_image, stats, centroids = cv.connectedComponentsWithStats(cleaned)
-    indices = np.indices(component_image.shape).T[:, :, [1, 0]]
-    components = [indices[component_image.T == i] for i in range(1, n)]
-    covariances = [np.cov(component, rowvar=False) for component in components]
-
-    observations = [
-        Observation(centroids[i + 1], covariance)
-        for i, (component, covariance) in enumerate(zip(components, covariances))
-    ]
-    observations = [
-        split_o for obs in observations for split_o in maybe_split(obs)
-    ]
-    return observations
+# Side of the square blocks used to find the parts of a frame with any foreground
+BLOCK_SIZE = 4
+# Above this fraction of active blocks, it's quicker to process the whole frame at once
+_MAX_ACTIVE_FRACTION = 0.3
+
+_CROSS = cv.getStructuringElement(cv.MORPH_CROSS, (3, 3))
+
+
+def observations_from_frame(frame, config=None):
+    config = params.resolve(config)
+    centroids, covariances = foreground_components(frame, config.OBS_FOREGROUND_THRESHOLD)
+    return split_large_observations(centroids, covariances, config)
+
+
+def foreground_components(frame, threshold, block_size=BLOCK_SIZE):
+    """
+    Thresholds a foreground frame, cleans it up with a morphological opening, and returns
+    the centroids and covariances of its 8-connected components, ordered by their first
+    pixel in raster order.
+
+    Objects usually cover a tiny fraction of the frame, so rather than processing all of
+    it, the frame is reduced to the max over each block of `block_size` pixels, and
+    8-connected groups of blocks over the threshold are found at that size. A block is
+    over the threshold exactly when one of its pixels is, so the components are all
+    within those groups. The groups' full resolution patches are then packed into one
+    image, a block apart, and opened and labelled all at once. An opening only looks two
+    pixels away, and blocks are at least two pixels across, so patches a block apart
+    can't affect each other, and neither can the blocks of other groups within a group's
+    bounding box, which are at least a block away from it. This gives exactly the
+    components of the whole frame.
+    """
+    coarse = cv.threshold(_block_max(frame, block_size), threshold, 1, cv.THRESH_BINARY)[1]
+    if np.count_nonzero(coarse) > _MAX_ACTIVE_FRACTION * coarse.size:
+        xs, ys, labels, n = _label_components(
+            cv.threshold(frame, threshold, 1, cv.THRESH_BINARY)[1])
+        return _ranked_moments(xs, ys, labels, n, frame.shape[1])
+
+    num_groups, groups, stats, _ = cv.connectedComponentsWithStats(coarse, connectivity=8)
+    if num_groups == 1:
+        return np.empty((0, 2)), np.empty((0, 2, 2))
+    boxes = stats[1:, :4]
+    packed, (packed_width, packed_height) = _pack(boxes[:, 2:], coarse.shape[1])
+
+    # Each group's blocks, at its place in the packed image
+    packed_groups = np.zeros((packed_height, packed_width), dtype=groups.dtype)
+    owners = np.zeros_like(packed_groups)
+    patches = np.zeros((packed_height * block_size, packed_width * block_size), dtype=np.uint8)
+    for group, ((x, y, w, h), (px, py)) in enumerate(zip(boxes.tolist(), packed.tolist()), 1):
+        packed_groups[py:py + h, px:px + w] = groups[y:y + h, x:x + w]
+        owners[py:py + h, px:px + w] = group
+        patch = frame[y * block_size:(y + h) * block_size, x * block_size:(x + w) * block_size]
+        patches[py * block_size:py * block_size + patch.shape[0],
+                px * block_size:px * block_size + patch.shape[1]] = patch
+
+    thresholded = cv.threshold(patches, threshold, 1, cv.THRESH_BINARY)[1]
+    # Other groups' blocks within a group's bounding box are left to that group
+    own = cv.resize((packed_groups == owners).view(np.uint8), thresholded.shape[::-1],
+                    interpolation=cv.INTER_NEAREST)
+    xs, ys, labels, n = _label_components(thresholded * own)
+
+    # Back to frame coordinates
+    group = owners[ys // block_size, xs // block_size] - 1
+    xs = xs + (boxes[group, 0] - packed[group, 0]) * block_size
+    ys = ys + (boxes[group, 1] - packed[group, 1]) * block_size
+    return _ranked_moments(xs, ys, labels, n, frame.shape[1])
+
+
+def _label_components(thresholded):
+    """
+    Opens a thresholded image and returns the (x, y) coordinates of the pixels of its
+    8-connected components, in raster order, their labels 0, ..., n - 1, and n.
+    """
+    cleaned = cv.morphologyEx(thresholded, cv.MORPH_OPEN, _CROSS,
+                              borderType=cv.BORDER_CONSTANT, borderValue=0)
+    num_labels, component_image = cv.connectedComponents(cleaned, connectivity=8)
+    ys, xs = np.nonzero(component_image)
+    return xs, ys, component_image[ys, xs] - 1, num_labels - 1
+
+
+def _ranked_moments(xs, ys, labels, n, width):
+    """
+    `component_moments`, with the components ordered by their first pixel in raster
+    order, given that each component's own pixels are in raster order.
+    """
+    if n == 0:
+        return np.empty((0, 2)), np.empty((0, 2, 2))
+    _, first = np.unique(labels, return_index=True)
+    rank = np.empty((n,), dtype=np.intp)
+    rank[np.argsort(ys[first] * width + xs[first], kind='stable')] = np.arange(n)
+    return component_moments(rank[labels], xs, ys, n)
 
 
-def maybe_split(observation):
-    evals, evecs = np.linalg.eigh(observation.covariance)
-    if evals[0] == 0.0:
-        return []
-    if evals[1] < params.OBS_LARGE_COVARIANCE_SPLIT_THRESHOLD:
-        return [observation]
-
-    centroid = observation.centroid
-    cov = np.dot(np.dot(evecs.T, np.diag([evals[0], 0.25 * evals[1]])), evecs)
-    diff = evecs[1] * np.sqrt(evals[1])
-    return [
-        Observation(centroid + diff, cov),
-        Observation(centroid - diff, cov),
-    ]
+def _block_max(frame, size):
+    """
+    Returns the max over each `size`×`size` block of a frame; blocks which run off the
+    right or bottom edge are the max over the part which doesn't.
+    """
+    # Anchored at the top left, so that each block's max lands on its first pixel
+    kernel = np.ones((size, size), dtype=np.uint8)
+    pooled = cv.dilate(frame, kernel, anchor=(0, 0), borderType=cv.BORDER_REPLICATE)
+    return np.ascontiguousarray(pooled[::size, ::size])
+
+
+def _pack(sizes, width):
+    """
+    Places boxes of the given (width, height) in rows, left to right, with a gap of one
+    between boxes and between rows, and rows no wider than `width` (unless a box is).
+    Returns the top left corner of each box, and the (width, height) of the whole.
+    """
+    corners = np.empty_like(sizes)
+    x = y = row_height = total_width = 0
+    for i, (w, h) in enumerate(sizes.tolist()):
+        if x > 0 and x + w > width:
+            x, y, row_height = 0, y + row_height + 1, 0
+        corners[i] = x, y
+        x += w + 1
+        row_height = max(row_height, h)
+        total_width = max(total_width, x - 1)
+    return corners, (total_width, y + row_height)
+
+
+def component_moments(labels, xs, ys, n):
+    """
+    Takes the label 0, ..., n - 1 and (x, y) coordinates of each pixel of some
+    components, and returns the centroid of each component, shape (n, 2), and the sample
+    covariance of its pixel coordinates, shape (n, 2, 2). This makes a single pass over
+    the pixels, accumulating per-label sums with `np.bincount`.
+    """
+    counts = np.bincount(labels, minlength=n)
+    means_x = np.bincount(labels, xs, minlength=n) / counts
+    means_y = np.bincount(labels, ys, minlength=n) / counts
+    dx = xs - means_x[labels]
+    dy = ys - means_y[labels]
+
+    covariances = np.empty((n, 2, 2))
+    covariances[:, 0, 0] = np.bincount(labels, dx * dx, minlength=n)
+    covariances[:, 0, 1] = covariances[:, 1, 0] = np.bincount(labels, dx * dy, minlength=n)
+    covariances[:, 1, 1] = np.bincount(labels, dy * dy, minlength=n)
+    covariances /= (counts - 1)[:, None, None]
+    return np.stack([means_x, means_y], axis=-1), covariances
+
+
+def eigh_2x2(matrices):
+    """
+    Closed form `np.linalg.eigh` for a stack of symmetric 2×2 matrices: returns the
+    eigenvalues in ascending order, shape (N, 2), and the eigenvectors as columns,
+    shape (N, 2, 2), with the same signs as LAPACK gives.
+    """
+    a, b, d = matrices[:, 0, 0], matrices[:, 0, 1], matrices[:, 1, 1]
+    # Like LAPACK, treat a negligible off-diagonal as exactly zero
+    eps = 0.5 * np.finfo(matrices.dtype).eps
+    b = np.where(np.abs(b) <= eps * np.sqrt(np.abs(a)) * np.sqrt(np.abs(d)), 0., b)
+    half_trace = 0.5 * (a + d)
+    radius = np.hypot(0.5 * (a - d), b)
+    large = half_trace + radius
+    with np.errstate(divide='ignore', invalid='ignore'):
+        small = np.where(large > 0, (a * d - b * b) / large, half_trace - radius)
+
+    # Eigenvector of the large eigenvalue, from whichever row of (M - large I) is better
+    # conditioned. It's undefined only for multiples of the identity.
+    a_ge_d = a >= d
+    vx = np.abs(np.where(a_ge_d, large - d, b))
+    vy = np.abs(np.where(a_ge_d, b, large - a))
+    norm = np.hypot(vx, vy)
+    isotropic = norm == 0
+    norm[isotropic] = 1.
+    vx, vy = vx / norm, vy / norm
+    vy[isotropic] = 1.
+
+    # LAPACK returns the reflection [[-vy, vx], [vx, vy]] with these signs, except
+    # that diagonal matrices with a <= d get the identity.
+    vx[(b < 0) | ((b > 0) & (a > d))] *= -1
+    vy[(b > 0) & (a > d)] *= -1
+
+    evals = np.stack([small, large], axis=-1)
+    evecs = np.stack([np.stack([-vy, vx], axis=-1), np.stack([vx, vy], axis=-1)], axis=-2)
+    evecs[(b == 0) & ~(a > d), 0, 0] = 1.
+    return evals, evecs
+
+
+def split_large_observations(centroids, covariances, config=None):
+    """
+    Turns component centroids and covariances into observations. Components with a
+    degenerate covariance are dropped, and components that are too elongated (probably
+    two objects touching) are split in two along their major axis.
+    """
+    config = params.resolve(config)
+    evals, evecs = eigh_2x2(covariances)
+    degenerate = evals[:, 0] == 0.0
+    large = evals[:, 1] >= config.OBS_LARGE_COVARIANCE_SPLIT_THRESHOLD
+
+    split_evals = evals * [1., 0.25]
+    split_covariances = np.swapaxes(evecs, 1, 2) @ (split_evals[:, :, None] * evecs)
+    diffs = evecs[:, 1] * np.sqrt(evals[:, 1:])
+
+    observations = []
+    for i in range(len(centroids)):
+        if degenerate[i]:
+            continue
+        if not large[i]:
+            observations.append(Observation(centroids[i], covariances[i]))
+            continue
+        observations.append(Observation(centroids[i] + diffs[i], split_covariances[i]))
+        observations.append(Observation(centroids[i] - diffs[i], split_covariances[i]))
+    return observations
@@ -1,17 +1,54 @@
 import json
-try:
-    import importlib.resources as pkg_resources
-except ImportError:
-    import importlib_resources as pkg_resources
+import os
 
-import multi_object_tracking
+DEFAULTS = os.path.join(os.path.dirname(__file__), 'default_params.json')
+
+_values = {}
 
 
 def init(filename=None):
-    with (open(filename) if filename is not None else
-          pkg_resources.open_text(multi_object_tracking, 'default_params.json')) as f:
+    with open(filename if filename is not None else DEFAULTS) as f:
         params = json.load(f)
-        globals().update(**params)
+        update(params)
+
+
+def update(params):
+    _values.update(params)
+    globals().update(**params)
+
+
+def current():
+    """
+    Returns the parameter values currently in effect, e.g. to pass to `update` in a
+    worker process.
+    """
+    return dict(_values)
+
+
+class Params:
+    """
+    An explicit set of parameter values, read as attributes just like the module level
+    ones (`config.ASSOC_LOG_LKL_THRESHOLD`). Functions which take a `config` use it in
+    place of the module level values, so several configurations can run in one process.
+    By default it holds a copy of the values currently in effect.
+    """
+
+    def __init__(self, values=None):
+        self.__dict__.update(current() if values is None else values)
+
+    def values(self):
+        return dict(self.__dict__)
+
+    def replace(self, **changes):
+        return Params({**self.values(), **changes})
+
+    def __repr__(self):
+        return f'Params({self.values()!r})'
+
+
+def resolve(config=None):
+    """Returns `config`, or the values currently in effect if it's None."""
+    return Params() if config is None else config
 
 
 init()
@@ -0,0 +1,117 @@
+"""
+Runs stages of a generator chain on their own threads, so that stages which release
+the GIL (video decoding, NumPy, OpenCV) can overlap.
+"""
+import collections
+import queue
+import threading
+
+_DONE = object()
+
+# Items buffered between a stage and the next by default
+MAXSIZE = 8
+
+
+class _Failure:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def threaded(iterable, maxsize=MAXSIZE):
+    """
+    Iterates over `iterable` on a background thread and yields its items, in order.
+
+    At most `maxsize` items are buffered, after which the background thread waits for
+    the consumer to catch up. An exception raised by `iterable` is re-raised in the
+    consumer. When the returned generator is closed (or garbage collected) before it's
+    exhausted, the background thread stops and closes `iterable`, so that a chain of
+    threaded stages shuts down from the end all the way back to the start.
+    """
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(_DONE)
+        except BaseException as e:
+            put(_Failure(e))
+        finally:
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.exception
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def latest(iterable, maxsize=4):
+    """
+    Like `threaded`, but the background thread never waits for the consumer: once
+    `maxsize` items are buffered, each new item pushes out the oldest one. This suits
+    live sources which can't be paused, where skipping items is better than falling
+    further and further behind.
+    """
+    items = collections.deque()
+    ready = threading.Condition()
+    stop = threading.Event()
+
+    def put(item, droppable=True):
+        with ready:
+            if droppable and len(items) >= maxsize:
+                items.popleft()
+            items.append(item)
+            ready.notify()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                put(item)
+            put(_DONE, droppable=False)
+        except BaseException as e:
+            put(_Failure(e), droppable=False)
+        finally:
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            with ready:
+                while not items:
+                    ready.wait()
+                item = items.popleft()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.exception
+            yield item
+    finally:
+        stop.set()
+        thread.join()
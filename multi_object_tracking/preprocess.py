@@ -1,6 +1,7 @@
-from collections import deque
 import itertools
 import os
+import shutil
+import subprocess
 
 import cv2 as cv
 import numpy as np
@@ -8,24 +9,277 @@ import numpy as np
 from . import params
 
 
-def stream_video(filename):
+def stream_video(filename, roi=None, start=0, decimate=1, buffers=None, decoder='opencv',
+                 stride=1):
     """
     Frames are rgb but with identical values; just read as greyscale.
-    Takes a path and returns a generator consisting of greyscale frames.
+    Takes a path and returns a generator of greyscale frames, as contiguous arrays.
+    If `roi` is given as (x0, y0, x1, y1), frames are cropped to that box, and if
+    `decimate` is more than 1, they're then shrunk by that factor by averaging.
+    If `start` is given, the video is read from that frame on, and it's a ValueError if
+    there's no frame there. With `stride`, only every `stride`-th frame from there on is
+    returned; the ones in between are skipped without being converted or copied.
+
+    By default each frame is a new array. If `buffers` is given, frames are written into
+    a ring of that many arrays which are allocated once, so each frame is only valid
+    until `buffers` more frames have been read.
+
+    With decoder 'ffmpeg', frames are decoded straight to greyscale by an ffmpeg process,
+    which must be on the PATH. Its greyscale conversion can differ from OpenCV's by a
+    grey level or two.
+    """
+    if not os.path.isfile(filename):
+        raise FileNotFoundError(f"Can't find file {filename}")
+    if decoder not in ('opencv', 'ffmpeg'):
+        raise ValueError(f'Unknown decoder {decoder}')
+
+    if decoder == 'ffmpeg':
+        frames = _stream_ffmpeg(filename, roi, start, decimate, buffers, stride)
+    else:
+        frames = _stream_opencv(filename, roi, start, decimate, buffers, stride)
+    first = next(frames, None)
+    if first is None:
+        if start:
+            raise ValueError(f"Can't read from frame {start} of {filename}, which has "
+                             f'{video_length(filename)} frames')
+        raise ValueError(f'No frames found in {filename}, is it a valid video?')
+    yield first
+    yield from frames
+
+
+def _frame_buffers(shape, buffers):
+    """Yields an array of `shape` for each frame to be written into."""
+    if buffers is None:
+        while True:
+            yield np.empty(shape, dtype=np.uint8)
+    yield from itertools.cycle([np.empty(shape, dtype=np.uint8) for _ in range(buffers)])
+
+
+def _stream_opencv(filename, roi, start, decimate, buffers, stride):
+    vc = cv.VideoCapture(filename)
+    if start:
+        vc.set(cv.CAP_PROP_POS_FRAMES, start)
+        if int(vc.get(cv.CAP_PROP_POS_FRAMES)) != start:
+            # Seeking isn't supported; skip ahead by decoding
+            vc = cv.VideoCapture(filename)
+            for _ in range(start):
+                vc.grab()
+
+    x0, y0, x1, y1 = roi or (0, 0, None, None)
+    bgr = gray = outs = None
+    try:
+        while vc.grab():
+            # Decode into the same buffer every time, and copy out the part we need
+            _, bgr = vc.retrieve(bgr)
+            crop = bgr[y0:y1, x0:x1]
+            if outs is None:
+                height, width = crop.shape[0] // decimate, crop.shape[1] // decimate
+                outs = _frame_buffers((height, width), buffers)
+                if decimate > 1:
+                    gray = np.empty(crop.shape[:2], dtype=np.uint8)
+            out = next(outs)
+            if decimate > 1:
+                cv.extractChannel(crop, 0, gray)
+                cv.resize(gray, (width, height), out, interpolation=cv.INTER_AREA)
+            else:
+                cv.extractChannel(crop, 0, out)
+            yield out
+            # Once the end is reached, the next grab fails too
+            for _ in range(stride - 1):
+                vc.grab()
+    finally:
+        vc.release()
+
+
+def _stream_ffmpeg(filename, roi, start, decimate, buffers, stride):
+    if shutil.which('ffmpeg') is None:
+        raise FileNotFoundError("Can't find ffmpeg on the PATH")
+    height, width = video_shape(filename)
+    x0, y0, x1, y1 = roi or (0, 0, width, height)
+    width, height = (x1 - x0) // decimate, (y1 - y0) // decimate
+
+    command = ['ffmpeg', '-v', 'error', '-nostdin']
+    if start:
+        # Seeking to a time decodes from the keyframe before it and drops the frames
+        # before that time, so aim half a frame early to land exactly on frame `start`.
+        vc = cv.VideoCapture(filename)
+        fps = vc.get(cv.CAP_PROP_FPS)
+        vc.release()
+        command += ['-ss', f'{(start - .5) / fps:.6f}']
+    command += ['-i', filename, '-an', '-vsync', 'passthrough']
+    filters = []
+    if stride > 1:
+        # Frames are numbered from the one seeked to
+        filters.append(f'select=not(mod(n\\,{stride}))')
+    if roi is not None:
+        filters.append(f'crop={x1 - x0}:{y1 - y0}:{x0}:{y0}')
+    if decimate > 1:
+        filters.append(f'scale={width}:{height}:flags=area')
+    if filters:
+        command += ['-vf', ','.join(filters)]
+    command += ['-f', 'rawvideo', '-pix_fmt', 'gray', '-']
+
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        yield from stream_raw(process.stdout, width, height, buffers=buffers)
+        if process.wait() != 0:
+            raise ValueError(f'ffmpeg failed to decode {filename}: '
+                             f'{process.stderr.read().decode(errors="replace").strip()}')
+    finally:
+        process.kill()
+        process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+
+def stream_capture(source, roi=None):
+    """
+    Like `stream_video`, but for anything OpenCV can open: a camera index, a stream URL
+    such as rtsp://..., or a file. Colour frames are converted to greyscale. Yields
+    frames until the source ends.
     """
+    vc = cv.VideoCapture(source)
+    if not vc.isOpened():
+        raise ValueError(f"Can't open {source}")
+
+    x0, y0, x1, y1 = roi or (0, 0, None, None)
+    try:
+        while True:
+            success, frame = vc.read()
+            if not success:
+                return
+            if frame.ndim == 3:
+                frame = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+            yield frame[y0:y1, x0:x1]
+    finally:
+        vc.release()
+
+
+def stream_raw(stream, width, height, roi=None, buffers=None):
+    """
+    Yields greyscale frames read from a binary stream of raw 8-bit pixels, `width` by
+    `height` per frame, e.g. standard input fed by
+    `ffmpeg -i $SOURCE -f rawvideo -pix_fmt gray -`. Stops at the end of the stream.
+    Frames are new arrays, unless `buffers` is given (see `stream_video`).
+    """
+    x0, y0, x1, y1 = roi or (0, 0, None, None)
+    size = width * height
+    for frame in _frame_buffers((height, width), buffers):
+        view = memoryview(frame).cast('B')
+        got = 0
+        while got < size:
+            n = stream.readinto(view[got:])
+            if not n:
+                return
+            got += n
+        yield frame[y0:y1, x0:x1]
+
+
+def video_shape(filename):
+    """Returns the (height, width) of the frames of a video."""
     if not os.path.isfile(filename):
         raise FileNotFoundError(f"Can't find file {filename}")
 
     vc = cv.VideoCapture(filename)
-    success, frame = vc.read()
-    if not success:
+    height = int(vc.get(cv.CAP_PROP_FRAME_HEIGHT))
+    width = int(vc.get(cv.CAP_PROP_FRAME_WIDTH))
+    vc.release()
+    if height == 0 or width == 0:
         raise ValueError(f'No frames found in {filename}, is it a valid video?')
+    return height, width
+
+
+def video_length(filename):
+    """
+    Returns the number of frames in a video, as reported by its container. This can be
+    an estimate for some formats.
+    """
+    if not os.path.isfile(filename):
+        raise FileNotFoundError(f"Can't find file {filename}")
 
-    while True:
-        yield frame[:, :, 0]
-        success, frame = vc.read()
-        if not success:
-            break
+    vc = cv.VideoCapture(filename)
+    length = int(vc.get(cv.CAP_PROP_FRAME_COUNT))
+    vc.release()
+    return length
+
+
+class SlidingWindowMax:
+    """
+    Running elementwise maximum over the last `buflen` frames pushed.
+
+    This is the van Herk/Gil-Werman algorithm: the stream is cut into blocks of
+    `buflen` frames, and every window of `buflen` consecutive frames straddles at most
+    two blocks. The max over the window is then the max of a suffix of the previous
+    block and a prefix of the current one. Prefix maxima are kept as a running max,
+    and suffix maxima are computed in one backward pass whenever a block completes.
+    That is about three `np.maximum` calls per frame, no matter how long the window is.
+
+    All buffers are allocated on the first push and reused afterwards.
+    """
+
+    def __init__(self, buflen):
+        self.buflen = buflen
+        self.count = 0
+        self._frames = None
+        self._suffix = None
+        self._prefix = None
+
+    def push(self, frame, out=None):
+        """
+        Adds a frame and returns the max over the last `buflen` frames (or over all of
+        them, if fewer have been pushed so far). The result is written to `out` if
+        given; otherwise it is an internal buffer which is only valid until the next push.
+        """
+        if self._frames is None:
+            self._frames = np.empty((self.buflen,) + frame.shape, dtype=frame.dtype)
+            self._suffix = np.empty_like(self._frames)
+            self._prefix = np.empty_like(self._frames[0])
+
+        j = self.count % self.buflen
+        self._frames[j] = frame
+        if j == 0:
+            self._prefix[...] = frame
+        else:
+            np.maximum(self._prefix, frame, out=self._prefix)
+        self.count += 1
+
+        if j == self.buflen - 1:
+            # Block is complete; its suffix maxima serve the windows of the next block.
+            self._suffix[-1] = self._frames[-1]
+            for m in range(self.buflen - 2, -1, -1):
+                np.maximum(self._suffix[m + 1], self._frames[m], out=self._suffix[m])
+
+        if j == self.buflen - 1 or self.count <= self.buflen:
+            if out is None:
+                return self._prefix
+            out[...] = self._prefix
+            return out
+        if out is None:
+            out = np.empty_like(self._prefix)
+        return np.maximum(self._suffix[j + 1], self._prefix, out=out)
+
+    def frame(self, i):
+        """Returns the i-th pushed frame; only the last `buflen` are available."""
+        if not self.count - self.buflen <= i < self.count:
+            raise IndexError(f'Frame {i} is no longer in the window')
+        return self._frames[i % self.buflen]
+
+    def state(self):
+        """Returns the buffers as a dict of arrays, which `from_state` restores."""
+        if self._frames is None:
+            return dict(buflen=self.buflen, count=self.count)
+        return dict(buflen=self.buflen, count=self.count, frames=self._frames,
+                    suffix=self._suffix, prefix=self._prefix)
+
+    @classmethod
+    def from_state(cls, state):
+        window_max = cls(int(state['buflen']))
+        window_max.count = int(state['count'])
+        if 'frames' in state:
+            window_max._frames = np.array(state['frames'])
+            window_max._suffix = np.array(state['suffix'])
+            window_max._prefix = np.array(state['prefix'])
+        return window_max
 
 
 def foreground(stream):
@@ -46,30 +300,119 @@ def foreground(stream):
     of these two windows produces a foreground that works in either case.
     """
 
-    def left_window_max(stream, buflen):
-        left_window = deque(itertools.islice(stream, 0, buflen), buflen)
-        left_max = np.max(left_window, axis=0)
-        for frame in left_window:
-            yield left_max
+    return Foreground().process(stream)
+
+
+class Foreground:
+    """
+    The state behind `foreground`, which can be saved with `state` and restored with
+    `from_state` to carry on from the middle of a video.
+
+    Frame k gets the max over the past window [k - buflen + 1, k] and over the future
+    window [k, k + buflen - 1], both clamped to the ends of the video so that they
+    always contain exactly buflen frames (or the whole video, if it's shorter). Both are
+    values of the same trailing window max, M[i] = max(frames[i - buflen + 1:i + 1]):
+    the past window is M[k] and the future window is M[k + buflen - 1]. So we keep a
+    single sliding max and a ring of its last buflen values, and emit frame k once
+    frame k + buflen - 1 has been read.
+    """
+
+    def __init__(self, buflen=None):
+        self.buflen = buflen or params.PP_NUM_FRAMES_IN_MAX_BUFFER
+        self._window_max = SlidingWindowMax(self.buflen)
+        self._maxes = None
+        # Frames pushed in, and foreground frames emitted
+        self.count = 0
+        self.emitted = 0
+
+    def process(self, stream):
+        """
+        Pushes each frame of `stream` and yields foreground frames as they become ready,
+        then yields the rest once `stream` is exhausted.
+        """
         for frame in stream:
-            left_window.append(frame)
-            np.max(left_window, axis=0, out=left_max)
-            yield left_max
+            if self._maxes is None:
+                self._maxes = np.empty((self.buflen,) + frame.shape, dtype=frame.dtype)
+            self._window_max.push(frame, out=self._maxes[self.count % self.buflen])
+            self.count += 1
+            if self.count >= self.buflen:
+                yield self._emit(self.count - 1)
+
+        while self.emitted < self.count:
+            yield self._emit(self.count - 1)
+
+    def _emit(self, last):
+        k, buflen = self.emitted, self.buflen
+        left_max = self._maxes[min(max(k, buflen - 1), last) % buflen]
+        right_max = self._maxes[min(k + buflen - 1, last) % buflen]
+        self.emitted += 1
+        # Both windows contain frame k, so neither subtraction can wrap around.
+        return np.minimum(left_max, right_max) - self._window_max.frame(k)
+
+    def state(self):
+        state = {f'window_max_{key}': value for key, value in self._window_max.state().items()}
+        state.update(buflen=self.buflen, count=self.count, emitted=self.emitted)
+        if self._maxes is not None:
+            state.update(maxes=self._maxes)
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        background = cls(int(state['buflen']))
+        background._window_max = SlidingWindowMax.from_state({
+            key[len('window_max_'):]: value
+            for key, value in state.items() if key.startswith('window_max_')
+        })
+        background.count = int(state['count'])
+        background.emitted = int(state['emitted'])
+        if 'maxes' in state:
+            background._maxes = np.array(state['maxes'])
+        return background
 
-    def right_window_max(stream, buflen):
-        right_window = deque(itertools.islice(stream, 0, buflen), buflen)
-        right_max = np.empty_like(right_window[0])
+
+class CausalForeground:
+    """
+    A background model for live streams, which can't wait for the future window of
+    `Foreground`. Frame k's background is the max over the `buflen` frames ending
+    `lookahead` frames after it, so its foreground is ready as soon as frame
+    k + lookahead arrives. The window always contains frame k, so the subtraction can't
+    wrap around.
+
+    Like the past window of `Foreground`, this handles the background getting lighter,
+    but when it gets darker, the old brighter frames stay in the window for up to
+    `buflen` frames, and some of the background may show up as foreground meanwhile.
+    """
+
+    def __init__(self, buflen=None, lookahead=0):
+        self.buflen = buflen or params.PP_NUM_FRAMES_IN_MAX_BUFFER
+        if not 0 <= lookahead < self.buflen:
+            raise ValueError(f'The look-ahead must be at least 0 and less than {self.buflen}')
+        self.lookahead = lookahead
+        self._window_max = SlidingWindowMax(self.buflen)
+        # The last lookahead + 1 window maxes
+        self._maxes = None
+        self.count = 0
+        self.emitted = 0
+
+    def process(self, stream):
+        """
+        Pushes each frame of `stream` and yields foreground frames `lookahead` frames
+        behind, then yields the rest once `stream` is exhausted.
+        """
+        ring = self.lookahead + 1
         for frame in stream:
-            np.max(right_window, axis=0, out=right_max)
-            yield right_max
-            right_window.append(frame)
-        np.max(right_window, axis=0, out=right_max)
-        for frame in right_window:
-            yield right_max
-
-    buflen = params.PP_NUM_FRAMES_IN_MAX_BUFFER
-    s1, s2, s3 = itertools.tee(stream, 3)
-    for left_max, right_max, frame in zip(left_window_max(s1, buflen),
-                                          right_window_max(s2, buflen),
-                                          s3):
-        yield np.minimum(left_max - frame, right_max - frame)
+            if self._maxes is None:
+                self._maxes = np.empty((ring,) + frame.shape, dtype=frame.dtype)
+            self._window_max.push(frame, out=self._maxes[self.count % ring])
+            self.count += 1
+            if self.count > self.lookahead:
+                yield self._emit(self.count - 1)
+
+        while self.emitted < self.count:
+            yield self._emit(self.count - 1)
+
+    def _emit(self, last):
+        k = self.emitted
+        background = self._maxes[min(k + self.lookahead, last) % (self.lookahead + 1)]
+        self.emitted += 1
+        return background - self._window_max.frame(k)
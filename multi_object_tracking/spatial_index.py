@@ -0,0 +1,128 @@
+"""
+A spatial index over the filters' positions which is kept up to date as the filters
+move, instead of being rebuilt every frame.
+
+Positions are bucketed into vertical columns as wide as the query radius, and rows are
+kept sorted by column and then by y, as a single sorted array of keys
+`column * _STRIDE + y`. Everything within the radius of a point then lies in three runs
+of that order, one in each of the point's column and its two neighbours, which are
+found by binary search for the point's y ± the radius. Candidates from those runs are
+checked exactly.
+
+Objects only move a few pixels per frame, so after each predict or update the order is
+nearly sorted already, and it's restored with a stable sort (a timsort, which is close
+to linear on nearly sorted input) instead of being rebuilt from scratch. One set of
+columns is kept for each query radius in use.
+"""
+import numpy as np
+
+# Keys of neighbouring columns are this far apart, so that a column's y values don't
+# overlap the next column's unless they span millions of pixels (which only costs
+# extra candidates).
+_STRIDE = 2.**24
+# The runs are searched a little wider than the radius, so that rounding in the keys
+# can't lose a candidate
+_MARGIN = 1e-3
+
+
+class _Columns:
+    def __init__(self, width, positions):
+        self.width = width
+        self.keys = self._keys(positions)
+        self.order = np.argsort(self.keys, kind='stable')
+        self.sorted_keys = self.keys[self.order]
+
+    def _keys(self, positions):
+        return np.floor(positions[:, 0] / self.width) * _STRIDE + positions[:, 1]
+
+    def _resort(self):
+        self.order = self.order[np.argsort(self.keys[self.order], kind='stable')]
+        self.sorted_keys = self.keys[self.order]
+
+    def add(self, positions):
+        n = len(self.keys)
+        self.keys = np.concatenate([self.keys, self._keys(positions)])
+        self.order = np.concatenate([self.order, np.arange(n, len(self.keys))])
+        self._resort()
+
+    def move(self, rows, positions):
+        self.keys[rows] = self._keys(positions)
+        self._resort()
+
+    def remove(self, keep):
+        new_rows = np.cumsum(keep) - 1
+        self.order = new_rows[self.order[keep[self.order]]]
+        self.keys = self.keys[keep]
+        self.sorted_keys = self.keys[self.order]
+
+    def candidates(self, points):
+        """
+        Returns (rows, indices) as flat arrays, for every indexed row which is in the
+        column of `points[index]` or a neighbouring one, and within the column width of
+        it vertically.
+        """
+        columns = np.floor(points[:, 0] / self.width)
+        centres = ((columns + [[-1.], [0.], [1.]]) * _STRIDE + points[:, 1]).ravel()
+        reach = self.width + _MARGIN
+        lo = np.searchsorted(self.sorted_keys, centres - reach, side='left')
+        hi = np.searchsorted(self.sorted_keys, centres + reach, side='right')
+        counts = hi - lo
+        # For each candidate, its position in `order`: the start of its run plus its
+        # offset within the run
+        starts = np.repeat(lo - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        indices = np.repeat(np.tile(np.arange(len(points)), 3), counts)
+        return self.order[starts], indices
+
+
+class SpatialIndex:
+    """
+    Indexes rows by their (x, y) position. It must be told about every change to the
+    rows: `add` for new rows at the end, `move` for rows whose positions changed, and
+    `remove` when rows are dropped. The columns for a radius are built the first time
+    it's queried, from the positions passed to the query, and maintained from then on.
+    """
+
+    def __init__(self):
+        self._columns = {}
+
+    def _for_radius(self, radius, positions):
+        if radius not in self._columns:
+            self._columns[radius] = _Columns(radius, positions)
+        return self._columns[radius]
+
+    def add(self, positions):
+        for columns in self._columns.values():
+            columns.add(positions)
+
+    def move(self, rows, positions):
+        for columns in self._columns.values():
+            columns.move(rows, positions)
+
+    def remove(self, keep):
+        for columns in self._columns.values():
+            columns.remove(keep)
+
+    def query_radius(self, positions, points, radius):
+        """
+        Returns (rows, indices), in no particular order, for every row whose position
+        (given by `positions`, all rows' current positions) is within `radius` of
+        `points[index]`.
+        """
+        rows, indices = self._for_radius(radius, positions).candidates(points)
+        dx = positions[:, 0][rows] - points[:, 0][indices]
+        dy = positions[:, 1][rows] - points[:, 1][indices]
+        within = dx * dx + dy * dy <= radius * radius
+        return rows[within], indices[within]
+
+    def query_pairs(self, positions, states, radius):
+        """
+        Returns the pairs of rows (i, j), i < j, whose `states` (any vectors, such as full
+        filter states, of which `positions` are the first two coordinates) are within
+        `radius` of each other, as an array of shape (N, 2) in no particular order.
+        """
+        rows, others = self._for_radius(radius, positions).candidates(positions)
+        pairs = rows < others
+        rows, others = rows[pairs], others[pairs]
+        residual = states[rows] - states[others]
+        within = np.einsum('ij,ij->i', residual, residual) <= radius * radius
+        return np.stack([rows[within], others[within]], axis=-1)
@@ -1,76 +1,495 @@
+import concurrent.futures
+import contextlib
+import functools
 import itertools
+import os
+import tempfile
 
-import tqdm
+import numpy as np
 
 from . import update
 from . import association
+from . import checkpoint
+from .debug_output import DebugReader, DebugWriter
+from .detection_cache import DetectionCache
+from .kalman_filter import KalmanFilterBank
+from . import metrics as metrics_module
 from . import observation
 from . import params
+from . import pipeline
 from . import preprocess
 
 
-def track(filename, debug=False, start=0, end=None):
-    frames = preprocess.foreground(
-        itertools.islice(preprocess.stream_video(filename), start, end))
+def track(filename, debug=False, start=0, end=None, progress=True, pipelined=False, roi=None,
+          debug_writer=None, checkpoint_path=None, checkpoint_every=1000, resume=False,
+          detection_cache=None, config=None, capture_frames=None, metrics=None,
+          decoder='opencv', stride=1):
+    """
+    Parameters are read from `config` (a `params.Params`) if given, and otherwise from
+    the values currently in effect.
 
-    filters = []
+    If `debug` is True, debug data for each frame is returned as a list of dicts. To keep
+    memory bounded on long videos, pass a `debug_output.DebugWriter` as `debug_writer`
+    instead, and each frame is written out as soon as it's processed.
+
+    With `pipelined`, decoding, background subtraction and detection each run on their
+    own thread, connected by bounded queues, while tracking runs on the calling thread.
+    The results are the same either way.
+
+    If `roi` is given as (x0, y0, x1, y1), only that part of the frame is tracked, and
+    debug coordinates are relative to its top left corner. Frames are decoded by
+    `decoder` (see `preprocess.stream_video`).
+
+    If `checkpoint_path` is given, the state of the run is saved there every
+    `checkpoint_every` frames, and once more when it's done. With `resume`, a run picks
+    up from the checkpoint at `checkpoint_path` if there is one, seeking straight to the
+    first frame it hasn't read yet; the results are the same as for an uninterrupted run.
+    A `debug_writer` used with `resume` should be opened with `resume=True` too.
+
+    If `detection_cache` is a `detection_cache.DetectionCache`, the observations are read
+    from it when it has them for this video, frame range and detection parameters, and
+    stored in it otherwise, so that runs which only change the tracking parameters
+    don't need to decode the video again.
+
+    For evaluation, pass a set of frame numbers as `capture_frames` instead of `debug`.
+    Then the second return value is a dict from each of those frames to its positions,
+    as returned by `capture_record`, and nothing is recorded for any other frame.
+
+    If `metrics` is a `metrics.Metrics`, the time spent in each stage and counts of
+    observations and filters are recorded in it for each frame. Stage times can't be
+    separated when they run on their own threads, so it can't be used with `pipelined`.
+
+    With `stride`, only every `stride`-th frame from `start` is tracked, with the
+    parameters scaled to match (see `stride_config`), and the frames in between aren't
+    decoded. Each count is repeated for the frames up to the next tracked one, so the
+    counts are still one per frame of the video, but debug output and metrics have one
+    record per tracked frame, and a `debug_writer` must be opened with `frame_step` set to
+    the stride. It can't be used with checkpoints or capture_frames.
+    """
+    if debug and capture_frames is not None:
+        raise ValueError('Use either debug or capture_frames, not both')
+    if metrics is not None and pipelined:
+        raise ValueError('Metrics can only be recorded without pipelined')
+    if stride > 1 and (checkpoint_path is not None or capture_frames is not None):
+        raise ValueError('A stride can only be used without checkpoints or capture_frames')
+    if debug_writer is not None and debug_writer.frame_step != stride:
+        raise ValueError(f'The debug writer has a frame step of {debug_writer.frame_step}, '
+                         f'but the stride is {stride}')
+    config = stride_config(stride, config)
+    background = preprocess.Foreground(config.PP_NUM_FRAMES_IN_MAX_BUFFER)
+    filters = None
     filter_counts = []
 
-    # Returned, but only populated if debug is True
-    debug_data = []
+    if checkpoint_path is not None:
+        if debug or pipelined or capture_frames is not None:
+            raise ValueError(
+                'Checkpoints work with debug_writer, not debug, pipelined or capture_frames')
+        saved = None
+        if resume and os.path.isfile(checkpoint_path):
+            saved = checkpoint.load(checkpoint_path, start, end, config)
+            filter_counts = saved['filter_counts']
+            if not saved['done']:
+                background, filters = saved['background'], saved['filters']
+        if resume and debug_writer is not None:
+            debug_writer.rewind(len(filter_counts))
+        if saved is not None and saved['done']:
+            return filter_counts, []
+
+    detections = None
+    if detection_cache is not None:
+        key = detection_cache.key(filename, start, end, roi, config, decoder, stride)
+        detections = detection_cache.get(key, first=len(filter_counts))
+        if detections is not None and metrics is not None:
+            detections = metrics.timed(detections, 'observations')
+    if detections is None:
+        detections = detect(
+            filename, start, end, pipelined, roi, background, config, metrics, decoder,
+            stride)
+        # Only a run from the first frame sees all of the observations
+        if detection_cache is not None and not filter_counts:
+            detections = detection_cache.record(key, detections)
+
+    # Returned, but only populated if debug is True (or capture_frames is given)
+    debug_data = [] if capture_frames is None else {}
+
+    if progress:
+        # Imported here, so that worker processes which don't show progress start faster
+        import tqdm
+        detections = tqdm.tqdm(detections, initial=len(filter_counts))
+    if metrics is not None:
+        metrics.next_frame = start + len(filter_counts)
+        metrics.frame_step = stride
+    for observations, filters, invalid_filters in track_observations(
+            detections, filters, config, metrics, dt=stride):
+        # Add debug information
+        if debug:
+            debug_data.append(debug_record(observations, filters, invalid_filters))
+        if debug_writer is not None:
+            debug_writer.add_frame(observations, filters, invalid_filters)
+        frame_num = start + len(filter_counts)
+        if capture_frames is not None and frame_num in capture_frames:
+            debug_data[frame_num] = capture_record(observations, filters, invalid_filters)
+
+        filter_counts.append(int(np.count_nonzero(~invalid_filters)))
+
+        if checkpoint_path is not None and len(filter_counts) % checkpoint_every == 0:
+            checkpoint.save(checkpoint_path, start, end, background, filters,
+                            np.flatnonzero(~invalid_filters), filter_counts, config=config)
+
+    if checkpoint_path is not None:
+        checkpoint.save(checkpoint_path, start, end, None, None, None, filter_counts, done=True,
+                        config=config)
 
-    for frame in tqdm.tqdm(frames):
-        # Generate observations
-        observations = observation.observations_from_frame(frame)
+    if stride > 1 and filter_counts:
+        # The last tracked frame covers the frames up to the end, which weren't read
+        n = len(filter_counts)
+        length = (end if end is not None else preprocess.video_length(filename)) - start
+        length = min(max(length, (n - 1) * stride + 1), n * stride)
+        filter_counts = np.repeat(filter_counts, stride)[:length].tolist()
 
+    return filter_counts, debug_data
+
+
+def stride_config(stride, config=None):
+    """
+    Returns the parameters for tracking every `stride`-th frame, scaled from `config` (or
+    the values currently in effect) so that they mean the same in terms of the original
+    frames:
+      PP_NUM_FRAMES_IN_MAX_BUFFER: the tracked frames within the same span of frames
+      ASSOC_CANDIDATE_PIXEL_RADIUS: times `stride`, since objects move that much further
+        between tracked frames
+      ASSOC_LOG_LKL_THRESHOLD: plus 2 log(stride), the growth in the log determinant
+        term when the uncertainty in position grows by a factor of `stride`
+      TRACK_STALE_FILTER_CUTOFF: the tracked frames within the same number of frames,
+        rounded up
+    The filters' process noise is scaled by `KalmanFilterBank` itself.
+    """
+    config = params.resolve(config)
+    if stride == 1:
+        return config
+    return config.replace(
+        PP_NUM_FRAMES_IN_MAX_BUFFER=(config.PP_NUM_FRAMES_IN_MAX_BUFFER - 1) // stride + 1,
+        ASSOC_CANDIDATE_PIXEL_RADIUS=config.ASSOC_CANDIDATE_PIXEL_RADIUS * stride,
+        ASSOC_LOG_LKL_THRESHOLD=config.ASSOC_LOG_LKL_THRESHOLD + 2 * float(np.log(stride)),
+        TRACK_STALE_FILTER_CUTOFF=-(-config.TRACK_STALE_FILTER_CUTOFF // stride),
+    )
+
+
+def detect(filename, start=0, end=None, pipelined=False, roi=None, background=None,
+           config=None, metrics=None, decoder='opencv', stride=1):
+    """
+    Returns a generator of the list of observations in each frame (or each `stride`-th
+    frame). If `background` is a `preprocess.Foreground` which has already seen some
+    frames, decoding carries on after them. If `metrics` is given, each stage is timed
+    into it (and `pipelined` is ignored).
+    """
+    config = params.resolve(config)
+    if background is None:
+        background = preprocess.Foreground(config.PP_NUM_FRAMES_IN_MAX_BUFFER)
+    first = start + background.count * stride
+    if background.count and first >= preprocess.video_length(filename):
+        # A resumed run which had already read every frame
+        return iter(())
+
+    def stage(iterable, name):
+        if metrics is not None:
+            return metrics.timed(iterable, name)
+        return pipeline.threaded(iterable) if pipelined else iter(iterable)
+
+    # Background subtraction copies each frame in before asking for the next, so frames
+    # can be decoded into the same buffer, unless they queue up between threads: then
+    # the queued ones, the one being copied and the one being decoded need their own.
+    buffers = pipeline.MAXSIZE + 2 if pipelined and metrics is None else 1
+    frames = stage(itertools.islice(
+        preprocess.stream_video(
+            filename, roi, first, buffers=buffers, decoder=decoder, stride=stride),
+        None if end is None else max(0, -(-(end - first) // stride))), 'decode')
+    frames = stage(background.process(frames), 'foreground')
+    return stage(map(
+        functools.partial(observation.observations_from_frame, config=config), frames),
+        'observations')
+
+
+def track_observations(detections, filters=None, config=None, metrics=None, dt=1):
+    """
+    Runs the tracker over a stream of per-frame observations, starting from the filters
+    in `filters` if given, or else a bank stepping `dt` frames at a time. For each
+    frame, yields the observations, the filter bank, and a mask over the bank of the
+    filters which are invalid (duplicates or stale). The invalid filters are removed
+    from the bank when the generator is resumed, so the bank must be inspected before
+    asking for the next frame.
+
+    If `metrics` is a `metrics.Metrics`, each frame's tracking stages are timed and
+    counted into it.
+    """
+    config = params.resolve(config)
+    filters = KalmanFilterBank(config=config, dt=dt) if filters is None else filters
+    metrics = metrics_module.DISABLED if metrics is None else metrics
+
+    for observations in detections:
+        metrics.start()
         # Associate observations to existing filters
-        for f in filters:
-            f.predict()
-        associations, unassociated_observations = association.associate(filters, observations)
+        filters.predict()
+        metrics.lap('predict')
+        associations, unassociated_observations = association.associate(
+            filters, observations, config, metrics)
+        metrics.lap('associate')
 
         # Update filters with their corresponding observations
-        update.update(associations)
+        num_existing = len(filters)
+        update.update(filters, associations)
 
         # Make new filters for unassociated observations
-        new_filters = update.make_new_filters(unassociated_observations)
-        filters.extend(new_filters)
+        update.make_new_filters(filters, unassociated_observations)
+        metrics.lap('update')
 
         # If we have multiple filters tracking the same underlying object, mark
         # the redundant ones as being duplicates.
-        filters, duplicates = update.deduplicate(filters)
+        duplicates = np.zeros((len(filters),), dtype=bool)
+        duplicates[update.deduplicate(filters, config)] = True
         # Mark duplicates for debugging purposes
-        for f in duplicates:
-            f.is_duplicate = True
+        filters.is_duplicate[duplicates] = True
 
         # Remove stale filters
-        valid_filters = []
-        stale_filters = []
-        for f in filters:
-            valid_filters.append(f) \
-                if f.last_observed < params.TRACK_STALE_FILTER_CUTOFF \
-                else stale_filters.append(f)
-        filters = valid_filters
+        stale_filters = ~duplicates & (filters.last_observed >= config.TRACK_STALE_FILTER_CUTOFF)
+        invalid_filters = duplicates | stale_filters
+        metrics.lap('deduplicate')
 
-        # Add debug information
-        if debug:
-            debug_data.append({
-                'observations': [
-                    {
-                        'centroid': o.centroid.tolist(),
-                        'cov': o.covariance.tolist()
-                    }
-                    for o in observations
-                ],
-                'filters': {
-                    f.id: f.dump()
-                    for f in filters
-                },
-                'invalid_filters': {
-                    f.id: f.dump()
-                    for f in duplicates + stale_filters
-                }
-            })
-
-        filter_counts.append(len(filters))
+        if metrics is not metrics_module.DISABLED:
+            num_duplicates = np.count_nonzero(duplicates)
+            num_stale = np.count_nonzero(stale_filters)
+            metrics.count('num_observations', len(observations))
+            metrics.count('num_filters', len(filters) - num_duplicates - num_stale)
+            metrics.count('num_new_filters', len(filters) - num_existing)
+            metrics.count('num_duplicates', num_duplicates)
+            metrics.count('num_stale_filters', num_stale)
+            metrics.end_frame()
+
+        yield observations, filters, invalid_filters
 
+        filters.remove(invalid_filters)
+
+
+def debug_record(observations, filters, invalid_filters):
+    return {
+        'observations': [
+            {
+                'centroid': o.centroid.tolist(),
+                'cov': o.covariance.tolist()
+            }
+            for o in observations
+        ],
+        'filters': filters.dump(np.flatnonzero(~invalid_filters)),
+        'invalid_filters': filters.dump(np.flatnonzero(invalid_filters)),
+    }
+
+
+def capture_record(observations, filters, invalid_filters):
+    """
+    Returns just the positions in a frame: the predicted positions of the valid filters
+    as an N×2 array under 'filters', and the observation centroids as an M×2 array under
+    'observations'.
+    """
+    return {
+        'observations': np.array([o.centroid for o in observations]).reshape((-1, 2)),
+        'filters': filters.mean()[~invalid_filters],
+    }
+
+
+def tile_boxes(shape, layout):
+    """
+    Splits a frame of the given (height, width) into a grid of (rows, columns) tiles,
+    and returns their (x0, y0, x1, y1) boxes in row-major order.
+    """
+    (height, width), (rows, cols) = shape, layout
+    ys = [height * r // rows for r in range(rows + 1)]
+    xs = [width * c // cols for c in range(cols + 1)]
+    return [
+        (xs[c], ys[r], xs[c + 1], ys[r + 1])
+        for r in range(rows) for c in range(cols)
+    ]
+
+
+def track_tiled(filename, layout=(2, 2), debug=False, start=0, end=None, workers=None,
+                pipelined=False, detection_cache=None, config=None, decoder='opencv',
+                debug_writer=None):
+    """
+    Splits each frame into a grid of tiles, given by `layout` as (rows, columns), and runs
+    an independent tracker on each tile. This suits videos which are mosaics of separate
+    camera views, and keeps tracks from crossing the seams between them.
+
+    The tiles are tracked in a pool of `workers` processes (by default one per tile).
+    Returns the total count per frame, the count per frame for each tile (in row-major
+    order) and, if `debug` is True, debug data in full-frame coordinates. As with
+    `track`, pass a `debug_output.DebugWriter` as `debug_writer` to keep memory bounded
+    instead: each tile's debug output goes to a temporary file next to the writer's, and
+    they're merged into it a frame at a time.
+    """
+    boxes = tile_boxes(preprocess.video_shape(filename), layout)
+    kwargs = dict(debug=debug and debug_writer is None, start=start, end=end,
+                  progress=False, pipelined=pipelined, detection_cache=detection_cache,
+                  config=params.resolve(config), decoder=decoder)
+    workers = len(boxes) if workers is None else min(workers, len(boxes))
+
+    with contextlib.ExitStack() as stack:
+        debug_paths = _temporary_debug_paths(stack, debug_writer, len(boxes))
+        if workers <= 1:
+            results = [
+                _track_tile(filename, box, path, kwargs)
+                for box, path in zip(boxes, debug_paths)
+            ]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(
+                    workers, initializer=params.update,
+                    initargs=(params.current(),)) as executor:
+                futures = [
+                    executor.submit(_track_tile, filename, box, path, kwargs)
+                    for box, path in zip(boxes, debug_paths)
+                ]
+                results = [future.result() for future in futures]
+
+        tile_counts = [counts for counts, _ in results]
+        filter_counts = [sum(counts) for counts in zip(*tile_counts)]
+        debug_data = []
+        if debug_writer is not None:
+            readers = [stack.enter_context(DebugReader(path)) for path in debug_paths]
+            for record in merge_tile_debug_data(readers, boxes):
+                debug_writer.append(record)
+                if debug:
+                    debug_data.append(record)
+        elif debug:
+            debug_data = list(merge_tile_debug_data([data for _, data in results], boxes))
+    return filter_counts, tile_counts, debug_data
+
+
+def _temporary_debug_paths(stack, debug_writer, n):
+    """
+    Returns `n` paths in a temporary directory next to `debug_writer`'s file, which is
+    deleted when `stack` closes, or `n` Nones if there's no writer.
+    """
+    if debug_writer is None:
+        return [None] * n
+    directory = stack.enter_context(tempfile.TemporaryDirectory(
+        dir=os.path.dirname(os.path.abspath(debug_writer.path))))
+    return [os.path.join(directory, f'{i}.debug') for i in range(n)]
+
+
+def _track_tile(filename, box, debug_path, kwargs):
+    if debug_path is None:
+        return track(filename, roi=box, **kwargs)
+    with DebugWriter(debug_path) as writer:
+        return track(filename, roi=box, debug_writer=writer, **kwargs)
+
+
+def merge_tile_debug_data(tile_debug_data, boxes):
+    """
+    Combines per-tile debug data into debug data for the whole frame, and yields it a
+    frame at a time: positions are offset by each tile's corner, observation indices are
+    renumbered to index the concatenated observations, and filters get fresh ids so that
+    ids from tiles tracked in different processes can't collide. The debug data of each
+    tile can be any iterable of records, such as a `debug_output.DebugReader`.
+    """
+    new_ids = [{} for _ in boxes]
+
+    def relabel(tile, filters, offset, num_previous_observations):
+        merged = {}
+        for _id, f in filters.items():
+            if _id not in new_ids[tile]:
+                new_ids[tile][_id] = next(KalmanFilterBank.id_iter)
+            x = list(f['x'])
+            x[0] += offset[0]
+            x[1] += offset[1]
+            merged[new_ids[tile][_id]] = {
+                **f,
+                'last_observation': f['last_observation'] + num_previous_observations,
+                'x': x,
+            }
+        return merged
+
+    for frame_data in zip(*tile_debug_data):
+        merged = {'observations': [], 'filters': {}, 'invalid_filters': {}}
+        for tile, (data, (x0, y0, _, _)) in enumerate(zip(frame_data, boxes)):
+            num_previous = len(merged['observations'])
+            merged['observations'].extend(
+                {**o, 'centroid': [o['centroid'][0] + x0, o['centroid'][1] + y0]}
+                for o in data['observations']
+            )
+            for key in ('filters', 'invalid_filters'):
+                merged[key].update(relabel(tile, data[key], (x0, y0), num_previous))
+        yield merged
+
+
+def track_segmented(filename, num_segments=None, debug=False, start=0, end=None, workers=None,
+                    pipelined=False, config=None, decoder='opencv', debug_writer=None):
+    """
+    Splits the frames from `start` to `end` into `num_segments` consecutive segments (by
+    default one per CPU), and detects the objects in them in parallel, in a pool of
+    `workers` processes, while a single tracker runs through the segments' observations
+    in order on the calling process. Decoding and detection take most of the time, and
+    since the tracker carries its state across each boundary, the counts and debug data
+    are exactly those of `track`.
+
+    Each segment's detection starts PP_NUM_FRAMES_IN_MAX_BUFFER frames before the segment
+    and ends as many after it, so that the background windows of its frames are those of
+    a serial run. The observations are handed back through a `detection_cache` in a
+    temporary directory. As with `track`, pass a `debug_output.DebugWriter` as
+    `debug_writer` to write debug output as it's made rather than returning it.
+    """
+    config = params.resolve(config)
+    num_segments = num_segments or os.cpu_count()
+    workers = num_segments if workers is None else min(workers, num_segments)
+    length = (end if end is not None else preprocess.video_length(filename)) - start
+    bounds = [start + length * k // num_segments for k in range(num_segments + 1)]
+    bounds[-1] = end
+
+    pad = config.PP_NUM_FRAMES_IN_MAX_BUFFER
+    segments = []
+    for keep_start, keep_end in zip(bounds[:-1], bounds[1:]):
+        padded_start = max(start, keep_start - pad)
+        padded_end = None if keep_end is None else keep_end + pad
+        if padded_end is not None and end is not None:
+            padded_end = min(end, padded_end)
+        segments.append((padded_start, padded_end, keep_start, keep_end))
+
+    with contextlib.ExitStack() as stack:
+        directory = stack.enter_context(tempfile.TemporaryDirectory())
+        cache = DetectionCache(directory, max_bytes=float('inf'))
+        jobs = [
+            (filename, *segment, pipelined, config, decoder, directory, str(i))
+            for i, segment in enumerate(segments)
+        ]
+        if workers <= 1:
+            done = (_detect_segment(*job) for job in jobs)
+        else:
+            executor = stack.enter_context(concurrent.futures.ProcessPoolExecutor(
+                workers, initializer=params.update, initargs=(params.current(),)))
+            futures = [executor.submit(_detect_segment, *job) for job in jobs]
+            done = (future.result() for future in futures)
+
+        def detections():
+            for key in done:
+                yield from cache.get(key)
+
+        filter_counts = []
+        debug_data = []
+        for observations, filters, invalid_filters in track_observations(
+                detections(), config=config):
+            if debug:
+                debug_data.append(debug_record(observations, filters, invalid_filters))
+            if debug_writer is not None:
+                debug_writer.add_frame(observations, filters, invalid_filters)
+            filter_counts.append(int(np.count_nonzero(~invalid_filters)))
     return filter_counts, debug_data
+
+
+def _detect_segment(filename, padded_start, padded_end, keep_start, keep_end, pipelined,
+                    config, decoder, directory, key):
+    """Stores the observations of the frames from `keep_start` to `keep_end` under `key`."""
+    detections = detect(filename, padded_start, padded_end, pipelined, config=config,
+                        decoder=decoder)
+    kept = itertools.islice(
+        detections, keep_start - padded_start,
+        None if keep_end is None else keep_end - padded_start)
+    for _ in DetectionCache(directory, max_bytes=float('inf')).record(key, kept):
+        pass
+    return key
@@ -1,63 +1,42 @@
-from collections import defaultdict
-
 import numpy as np
-import scipy.spatial
+import scipy.sparse
+import scipy.sparse.csgraph
 
-from .kalman_filter import KalmanConstVelFilter
 from . import params
+from .association import best_observations
 
 
-def update(associations):
-    for flt, observation in associations:
-        flt.update(observation)
+def update(filters, associations):
+    rows = [row for row, _ in associations]
+    filters.update(rows, [observation for _, observation in associations])
 
 
-def make_new_filters(unassociated_observations):
-    return [KalmanConstVelFilter(j_obs) for j_obs in unassociated_observations]
+def make_new_filters(filters, unassociated_observations):
+    return filters.add(unassociated_observations)
 
 
-def deduplicate(filters):
+def deduplicate(filters, config=None):
+    """
+    Finds groups of filters whose states are all close together, and returns the rows
+    of all but the most certain filter (the one with the smallest covariance
+    determinant) in each group, in ascending order. Ties go to the earliest row.
+    """
+    config = params.resolve(config)
     if len(filters) == 0:
-        return filters, []
-
-    valid_filter_indices = set(range(len(filters)))
-
-    invalid_filters = []
-
-    filter_tree = scipy.spatial.cKDTree(
-        np.array([f._kf.x.reshape((4,)) for f in filters]))
-    nearby_pairs = filter_tree.query_pairs(params.UPD_DUP_FILTER_SQ_DIST_THRESHOLD)
-    components = connected_components(nearby_pairs)
-    for component in components:
-        best = min(
-            component,
-            key=lambda idx: np.linalg.det(filters[idx]._kf.P))
-        for idx in component:
-            if idx != best:
-                invalid_filters.append(filters[idx])
-                valid_filter_indices.discard(idx)
-
-    valid_filters = [filters[idx] for idx in valid_filter_indices]
-
-    return valid_filters, invalid_filters
-
-
-def connected_components(list_of_pairs):
-    nodes = set(n for pair in list_of_pairs for n in pair)
-    edges = defaultdict(set)
-    for a, b in list_of_pairs:
-        edges[a].add(b)
-        edges[b].add(a)
-    components = []
-    while nodes:
-        n = nodes.pop()
-        component = set([n])
-        components.append(component)
-        todo = set([n])
-        while todo:
-            m = todo.pop()
-            todo.update(edges[m].intersection(nodes))
-            nodes.difference_update(edges[m])
-            component.update(edges[m])
-            del edges[m]
-    return components
+        return np.empty((0,), dtype=np.intp)
+
+    pairs = filters.close_pairs(config.UPD_DUP_FILTER_SQ_DIST_THRESHOLD)
+    if len(pairs) == 0:
+        return np.empty((0,), dtype=np.intp)
+
+    graph = scipy.sparse.coo_matrix(
+        (np.ones((len(pairs),)), (pairs[:, 0], pairs[:, 1])), shape=(len(filters),) * 2)
+    _, components = scipy.sparse.csgraph.connected_components(graph, directed=False)
+
+    grouped = np.zeros((len(filters),), dtype=bool)
+    grouped[pairs.ravel()] = True
+    rows = np.flatnonzero(grouped)
+    # The filter with the smallest determinant in each component
+    _, best = best_observations(components[rows], rows, np.linalg.det(filters.P[rows]))
+    grouped[best] = False
+    return np.flatnonzero(grouped)
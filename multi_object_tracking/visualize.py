@@ -1,12 +1,23 @@
-import matplotlib.pyplot as plt
-from matplotlib.patches import Ellipse, Arrow
-from matplotlib.collections import PatchCollection
+import argparse
+import collections
+import concurrent.futures
+import os
+
+import cv2 as cv
 import numpy as np
 
 from . import params
+from .debug_output import DebugReader
+from .observation import eigh_2x2
+
+
+# matplotlib is imported by the plotting functions as they're called, so that rendering
+# with OpenCV in worker processes doesn't have to wait for it
 
 
 def plot_cov_ellipse(cov, pos, nstd=2, ax=None, **kwargs):
+    from matplotlib.patches import Ellipse
+
     vals, vecs = np.linalg.eigh(cov)
     angle = np.degrees(np.arctan2(vecs[0, 1], vecs[0, 0]))
 
@@ -16,6 +27,8 @@ def plot_cov_ellipse(cov, pos, nstd=2, ax=None, **kwargs):
 
 
 def plot_covariances(observation_list, **kwargs):
+    from matplotlib.collections import PatchCollection
+
     ellipses = [
         plot_cov_ellipse(o['cov'], o['centroid'], facecolor='none', edgecolor=o['color'], **kwargs)
         for o in observation_list
@@ -25,6 +38,9 @@ def plot_covariances(observation_list, **kwargs):
 
 
 def plot_observation_links(observation_list, filters):
+    from matplotlib.collections import PatchCollection
+    from matplotlib.patches import Arrow
+
     arrows = []
     for f in filters.values():
         if f['last_observed'] == 0:
@@ -47,13 +63,27 @@ def get_color(f):
 
 
 def plot_debug_data(debug_data, n, ax=None):
+    """
+    Plots frame n of `debug_data`, which is either a list of per-frame dicts, a
+    `DebugReader`, or the path of a debug output file. Only frame n is read from the file.
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import PatchCollection
+    from matplotlib.patches import Arrow
+
     ax = ax or plt.gca()
     current_collections = [c for c in ax.collections]
     for coll in current_collections:
         coll.remove()
 
-    observations = debug_data[n]['observations']
-    filters = {**debug_data[n]['filters'], **debug_data[n]['invalid_filters']}
+    if isinstance(debug_data, str):
+        with DebugReader(debug_data) as reader:
+            frame_data = reader[n]
+    else:
+        frame_data = debug_data[n]
+
+    observations = frame_data['observations']
+    filters = {**frame_data['filters'], **frame_data['invalid_filters']}
 
     # Observations
     obs_collection = plot_covariances(
@@ -94,3 +124,234 @@ def plot_debug_data(debug_data, n, ax=None):
     # Observations to filter centroids
     observation_link_collection = plot_observation_links(observations, filters)
     ax.add_collection(observation_link_collection)
+
+
+# The colours above, as BGR
+_BGR = {
+    'b': (255, 0, 0),
+    'orange': (0, 165, 255),
+    'red': (0, 0, 255),
+    'lightgreen': (144, 238, 144),
+    'yellow': (0, 255, 255),
+}
+_FILTER_COLORS = ('orange', 'red', 'lightgreen', 'yellow')
+
+# Coordinates are passed to OpenCV in 1/16ths of a pixel
+_SHIFT = 4
+
+
+def filter_colors(columns, stale_cutoff=None):
+    """
+    `get_color` for all of the filters in `DebugReader.columns` at once; returns an
+    index into _FILTER_COLORS for each. Filters are stale once they've gone
+    `stale_cutoff` records without an observation (by default
+    TRACK_STALE_FILTER_CUTOFF).
+    """
+    if stale_cutoff is None:
+        stale_cutoff = params.TRACK_STALE_FILTER_CUTOFF
+    return np.select(
+        [columns['is_duplicate'],
+         columns['last_observed'] >= stale_cutoff,
+         columns['age'] == 0],
+        [0, 1, 2], 3)
+
+
+def ellipse_outlines(centers, covariances, nstd=2, num_points=24):
+    """
+    Returns outlines of the `nstd` standard deviation ellipses of a stack of 2×2
+    covariances around `centers`, as polygons of shape (N, num_points, 2), oriented the
+    same way as `plot_cov_ellipse`.
+    """
+    evals, evecs = eigh_2x2(covariances.reshape((-1, 2, 2)))
+    radii = nstd * np.sqrt(np.maximum(evals, 0.))
+    angle = np.arctan2(evecs[:, 0, 1], evecs[:, 0, 0])
+    axis = np.stack([np.cos(angle), np.sin(angle)], axis=-1)
+    normal = np.stack([-axis[:, 1], axis[:, 0]], axis=-1)
+
+    t = np.linspace(0., 2 * np.pi, num_points, endpoint=False)
+    return centers.reshape((-1, 1, 2)) \
+        + (radii[:, None, 0] * np.cos(t))[:, :, None] * axis[:, None, :] \
+        + (radii[:, None, 1] * np.sin(t))[:, :, None] * normal[:, None, :]
+
+
+def arrow_lines(starts, ends, head=0.3):
+    """
+    Returns arrows from `starts` to `ends` as polylines of shape (N, 5, 2): the shaft, then
+    the two sides of the head, which are `head` times the length of the shaft.
+    """
+    direction = (starts - ends) * head
+    # Rotated by ±30 degrees
+    cos, sin = np.cos(np.pi / 6), np.sin(np.pi / 6)
+    left = np.stack([cos * direction[:, 0] - sin * direction[:, 1],
+                     sin * direction[:, 0] + cos * direction[:, 1]], axis=-1)
+    right = np.stack([cos * direction[:, 0] + sin * direction[:, 1],
+                      -sin * direction[:, 0] + cos * direction[:, 1]], axis=-1)
+    return np.stack([starts, ends, ends + left, ends, ends + right], axis=1)
+
+
+def _dashed(outlines):
+    """Splits closed outlines of shape (N, K, 2) into every other segment."""
+    closed = np.concatenate([outlines, outlines[:, :1]], axis=1)
+    segments = np.stack([closed[:, :-1:2], closed[:, 1::2]], axis=2)
+    return segments.reshape((-1, 2, 2))
+
+
+def _draw(image, polylines, color, closed=False):
+    if len(polylines):
+        points = np.round(polylines * (1 << _SHIFT)).astype(np.int32)
+        cv.polylines(image, list(points), closed, color, 1, cv.LINE_AA, _SHIFT)
+
+
+def draw_debug_frame(image, columns, stale_cutoff=None):
+    """
+    Draws one frame of debug output, as returned by `DebugReader.columns`, over a BGR
+    image in place, in the style of `plot_debug_data`: observations in blue, filters and
+    their velocities in the colours of `get_color` (see `filter_colors` for
+    `stale_cutoff`), and links from each observation to the filter it updated.
+    """
+    centroids, x, P = columns['centroid'], columns['x'], columns['P']
+    colors = filter_colors(columns, stale_cutoff)
+
+    _draw(image, ellipse_outlines(centroids, columns['cov']), _BGR['b'], closed=True)
+
+    # Links from observations to the filters they updated
+    linked = columns['last_observed'] == 0
+    links = np.stack(
+        [centroids[columns['last_observation'][linked]], x[linked, :2]], axis=1)
+    _draw(image, links, _BGR['b'])
+
+    positions = ellipse_outlines(x[:, :2], P[:, :2, :2])
+    arrows = arrow_lines(x[:, :2], x[:, :2] + x[:, 2:])
+    velocities = ellipse_outlines(x[:, :2] + x[:, 2:], P[:, 2:, 2:])
+    for index, name in enumerate(_FILTER_COLORS):
+        mine = colors == index
+        _draw(image, positions[mine], _BGR[name], closed=True)
+        _draw(image, arrows[mine], _BGR[name])
+        _draw(image, _dashed(velocities[mine]), _BGR[name])
+
+
+def _render_chunk(video, debug_path, start, first, last, scale):
+    """
+    Returns records `first` to `last` of the debug output drawn over their frames of the
+    video.
+    """
+    vc = cv.VideoCapture(video)
+    images = []
+    with DebugReader(debug_path) as reader:
+        step = reader.frame_step
+        vc.set(cv.CAP_PROP_POS_FRAMES, start + first * step)
+        # The stale cutoff in records, as `track.stride_config` scales it
+        stale_cutoff = -(-params.TRACK_STALE_FILTER_CUTOFF // step)
+        for n in range(first, last):
+            if n > first and not all(vc.grab() for _ in range(step - 1)):
+                break
+            success, image = vc.read()
+            if not success:
+                break
+            columns = reader.columns(n)
+            if scale != 1:
+                image = cv.resize(image, None, fx=scale, fy=scale,
+                                  interpolation=cv.INTER_NEAREST)
+                # Pixel centres stay at integer coordinates
+                columns = {
+                    **columns,
+                    'centroid': (columns['centroid'] + .5) * scale - .5,
+                    'cov': columns['cov'] * scale ** 2,
+                    'x': np.concatenate([(columns['x'][:, :2] + .5) * scale - .5,
+                                         columns['x'][:, 2:] * scale], axis=1),
+                    'P': columns['P'] * scale ** 2,
+                }
+            draw_debug_frame(image, columns, stale_cutoff)
+            images.append(image)
+    vc.release()
+    return images
+
+
+def render_video(video, debug_path, out, start=0, end=None, scale=1, workers=None,
+                 chunk_size=16, progress=True):
+    """
+    Writes an MP4 to `out` of `video` with the debug output at `debug_path` drawn over each
+    frame (see `draw_debug_frame`). `start` is the frame of the video at which tracking
+    started, and frames of the debug output from there until `end` (by default all of
+    them) are drawn. With `scale`, frames are enlarged by that factor first, so that the
+    drawing is easier to see.
+
+    If tracking had a stride, only the tracked frames are drawn, and the MP4's frame rate
+    is divided by the stride so that it plays at the speed of the original.
+
+    Frames are drawn in chunks of `chunk_size` by a pool of `workers` processes (by default
+    one per CPU), and written in order by this one. Only a couple of chunks per worker
+    are in flight at once, so memory use doesn't grow with the length of the video.
+    """
+    with DebugReader(debug_path) as reader:
+        step = reader.frame_step
+        num_frames = len(reader) if end is None else min(len(reader), -(-(end - start) // step))
+    vc = cv.VideoCapture(video)
+    fps = (vc.get(cv.CAP_PROP_FPS) or 25) / step
+    width = int(vc.get(cv.CAP_PROP_FRAME_WIDTH)) * scale
+    height = int(vc.get(cv.CAP_PROP_FRAME_HEIGHT)) * scale
+    vc.release()
+
+    writer = cv.VideoWriter(out, cv.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    if not writer.isOpened():
+        raise ValueError(f"Can't write a video to {out}")
+
+    chunks = [
+        (video, debug_path, start, first, min(first + chunk_size, num_frames), scale)
+        for first in range(0, num_frames, chunk_size)
+    ]
+    import tqdm
+
+    workers = workers or os.cpu_count()
+    bar = tqdm.tqdm(total=num_frames, disable=not progress)
+    try:
+        if workers <= 1:
+            for chunk in chunks:
+                for image in _render_chunk(*chunk):
+                    writer.write(image)
+                bar.update(chunk[4] - chunk[3])
+            return
+
+        def write(future):
+            images = future.result()
+            for image in images:
+                writer.write(image)
+            bar.update(len(images))
+
+        with concurrent.futures.ProcessPoolExecutor(
+                workers, initializer=params.update, initargs=(params.current(),)) as executor:
+            pending = collections.deque()
+            for chunk in chunks:
+                pending.append(executor.submit(_render_chunk, *chunk))
+                if len(pending) > 2 * workers:
+                    write(pending.popleft())
+            while pending:
+                write(pending.popleft())
+    finally:
+        bar.close()
+        writer.release()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Render debug output over a video, as an MP4.')
+    parser.add_argument('video', help='Path to the video that was tracked.')
+    parser.add_argument('debug', help='Path to its debug output (a .debug file).')
+    parser.add_argument('-o', '--out', default='render.mp4', help='Path to write the MP4 to.')
+    parser.add_argument(
+        '-s', '--start', default=0, type=int,
+        help='The frame number at which tracking started. (Default 0.)')
+    parser.add_argument(
+        '-e', '--end', default=None, type=int,
+        help='The frame number at which to stop. (Stop at the end of the debug output by '
+             'default.)')
+    parser.add_argument(
+        '--scale', default=1, type=int, help='Enlarge frames by this factor. (Default 1.)')
+    parser.add_argument(
+        '-w', '--workers', default=None, type=int,
+        help='Number of processes to draw frames in. (Default one per CPU.)')
+    parser.add_argument(
+        '--params', help='The parameters file used for tracking, if not the default.')
+    args = parser.parse_args()
+    params.init(args.params)
+    render_video(args.video, args.debug, args.out, args.start, args.end, args.scale,
+                 args.workers)
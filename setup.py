@@ -3,8 +3,6 @@ from setuptools import setup, find_packages
 NAME = 'multi_object_tracking'
 
 install_requires = [
-    'filterpy>=1.4.5',
-    'importlib-resources; python_version < "3.7"',
     'matplotlib>=3.2.0',
     'numpy>=1.16',
     'opencv-python>=4.0.0',
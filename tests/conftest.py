@@ -0,0 +1,12 @@
+import pytest
+
+from multi_object_tracking.benchmark import synthetic
+
+
+@pytest.fixture(scope='session')
+def video(tmp_path_factory):
+    """A short synthetic video of 8 blobs, as (path, true positions)."""
+    path = str(tmp_path_factory.mktemp('videos') / 'blobs.avi')
+    positions = synthetic.make_video(
+        path, width=160, height=128, num_frames=60, num_objects=8, blob_size=6., seed=1)
+    return path, positions
@@ -0,0 +1,36 @@
+import os
+
+from multi_object_tracking import batch
+
+
+class _CrashingVideo:
+    """A video which kills the worker process it's sent to, as a decoder crash would."""
+
+    def __reduce__(self):
+        return os._exit, (1,)
+
+
+def test_count_videos_survives_a_crashed_worker(video):
+    path, _ = video
+    crashing = _CrashingVideo()
+    videos = [path, crashing, path, path]
+
+    results = list(batch.count_videos(videos, workers=2))
+
+    assert [v for v, _, _ in results] == videos
+    for v, line, error in results:
+        if v is crashing:
+            assert line is None and 'BrokenProcessPool' in error
+        else:
+            assert error is None and line.startswith(f'{path}: ')
+
+
+def test_count_video_creates_the_checkpoint_directory(video, tmp_path):
+    path, _ = video
+    checkpoint_dir = tmp_path / 'checkpoints'
+
+    line = batch.count_video(path, progress=False, checkpoint_dir=str(checkpoint_dir))
+
+    assert line == batch.count_video(path, progress=False)
+    assert [p.name for p in checkpoint_dir.iterdir()] == [
+        f'{os.path.basename(path)}.checkpoint.npz']
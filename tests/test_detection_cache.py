@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from multi_object_tracking.detection_cache import DetectionCache
+from multi_object_tracking.observation import Observation
+
+
+def _detections(num_frames, fail_at=None):
+    for i in range(num_frames):
+        if i == fail_at:
+            raise RuntimeError('Detection failed')
+        yield [Observation(np.array([i, 2. * i]), np.eye(2))]
+
+
+def test_record_stores_complete_detections(tmp_path):
+    cache = DetectionCache(str(tmp_path))
+    assert len(list(cache.record('key', _detections(5)))) == 5
+
+    stored = list(cache.get('key'))
+    assert [o.centroid.tolist() for frame in stored for o in frame] == \
+        [[i, 2. * i] for i in range(5)]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['key.index.npy', 'key.observations']
+
+
+def test_record_leaves_nothing_when_closed_early(tmp_path):
+    cache = DetectionCache(str(tmp_path))
+    recording = cache.record('key', _detections(5))
+    next(recording)
+    next(recording)
+    recording.close()
+
+    assert cache.get('key') is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_record_leaves_nothing_when_detection_fails(tmp_path):
+    cache = DetectionCache(str(tmp_path))
+    with pytest.raises(RuntimeError):
+        list(cache.record('key', _detections(5, fail_at=3)))
+
+    assert cache.get('key') is None
+    assert list(tmp_path.iterdir()) == []
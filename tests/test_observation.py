@@ -0,0 +1,39 @@
+import cv2 as cv
+import numpy as np
+import pytest
+
+from multi_object_tracking import observation
+
+
+def _whole_frame_components(frame, threshold):
+    thresholded = cv.threshold(frame, threshold, 1, cv.THRESH_BINARY)[1]
+    xs, ys, labels, n = observation._label_components(thresholded)
+    return observation._ranked_moments(xs, ys, labels, n, frame.shape[1])
+
+
+def _textured_frames(seed, height=61, width=83):
+    """An empty frame, one with textured patches here and there, and a dense one."""
+    rng = np.random.default_rng(seed)
+    sparse = np.zeros((height, width), np.uint8)
+    for x, y in rng.integers(0, [width, height], (6, 2)):
+        patch = sparse[y:y + 7, x:x + 9]
+        patch[:] = rng.integers(0, 70, patch.shape)
+    return [np.zeros((height, width), np.uint8), sparse,
+            rng.integers(0, 70, (height, width), np.uint8)]
+
+
+def test_empty_frame_has_no_observations():
+    assert observation.observations_from_frame(np.zeros((64, 64), np.uint8)) == []
+
+    centroids, covariances = observation.foreground_components(
+        np.zeros((64, 64), np.uint8), threshold=35)
+    assert centroids.shape == (0, 2) and covariances.shape == (0, 2, 2)
+
+
+@pytest.mark.parametrize('block_size', [2, 3, 4, 8])
+def test_components_match_whole_frame(block_size):
+    for frame in _textured_frames(block_size):
+        expected = _whole_frame_components(frame, 35)
+        found = observation.foreground_components(frame, 35, block_size)
+        for a, b in zip(found, expected):
+            np.testing.assert_array_equal(a, b)
@@ -0,0 +1,20 @@
+import pytest
+
+from multi_object_tracking import params, preprocess, track
+
+
+def test_start_past_the_end_is_an_error(video):
+    path, positions = video
+    with pytest.raises(ValueError, match=f'frame 100 of .* has {len(positions)} frames'):
+        next(preprocess.stream_video(path, start=100))
+    with pytest.raises(ValueError, match='frame 100'):
+        track.track(path, start=100, progress=False)
+
+
+def test_detect_after_the_last_frame_is_empty(video):
+    # As when resuming from a checkpoint saved at the last frame
+    path, _ = video
+    background = preprocess.Foreground(params.PP_NUM_FRAMES_IN_MAX_BUFFER)
+    for _ in background.process(preprocess.stream_video(path)):
+        pass
+    assert list(track.detect(path, background=background)) == []
@@ -0,0 +1,52 @@
+from multi_object_tracking import track
+from multi_object_tracking.debug_output import DebugReader, DebugWriter
+
+
+def _renumbered(records):
+    """Debug records with filter ids replaced by their order of first appearance."""
+    ids = {}
+    return [
+        {
+            'observations': record['observations'],
+            **{key: {ids.setdefault(_id, len(ids)): f for _id, f in record[key].items()}
+               for key in ('filters', 'invalid_filters')},
+        }
+        for record in records
+    ]
+
+
+def test_tiled_debug_writer_matches_debug(video, tmp_path):
+    path, _ = video
+    counts, _, debug_data = track.track_tiled(path, (2, 2), debug=True, workers=1)
+    with DebugWriter(str(tmp_path / 'tiled.debug')) as writer:
+        streamed_counts, _, _ = track.track_tiled(path, (2, 2), workers=1, debug_writer=writer)
+
+    assert streamed_counts == counts
+    assert _renumbered(DebugReader(writer.path)) == _renumbered(debug_data)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['tiled.debug']
+
+
+def test_segmented_debug_writer_matches_debug(video, tmp_path):
+    path, _ = video
+    counts, debug_data = track.track_segmented(path, 3, debug=True, workers=1)
+    with DebugWriter(str(tmp_path / 'segmented.debug')) as writer:
+        streamed_counts, _ = track.track_segmented(path, 3, workers=1, debug_writer=writer)
+
+    assert streamed_counts == counts
+    assert _renumbered(DebugReader(writer.path)) == _renumbered(debug_data)
+
+
+def test_segmented_counts_match_serial(video):
+    path, _ = video
+    counts, debug_data = track.track(path, debug=True, progress=False)
+    for num_segments in (2, 5):
+        segmented_counts, segmented_debug_data = track.track_segmented(
+            path, num_segments, debug=True, workers=2)
+        assert segmented_counts == counts
+        assert _renumbered(segmented_debug_data) == _renumbered(debug_data)
+
+
+def test_counts_are_python_ints(video):
+    path, _ = video
+    counts, _ = track.track(path, progress=False)
+    assert {type(count) for count in counts} == {int}